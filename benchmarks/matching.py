@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016-2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark for the matching of metadata fields against indexing patterns.
+
+Compares matching each pattern via ``fnmatch`` with the compiled
+matcher used by ``ckanext.extractor.config.is_field_indexed``. Run it
+in an environment in which CKAN and ckanext-extractor are installed::
+
+    python benchmarks/matching.py
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from fnmatch import fnmatch
+import timeit
+
+from pylons import config
+
+from ckanext.extractor.config import get, is_field_indexed
+
+
+PATTERNS = 'fulltext author x-* dc:* *:title meta:*-count'
+
+FIELDS = ['fulltext', 'Author', 'x-parsed-by', 'dc:creator', 'pdf:title',
+          'meta:page-count', 'content-type', 'created']
+
+
+def uncompiled():
+    for field in FIELDS:
+        patterns = get('indexed_fields')
+        any(fnmatch(field.lower(), p) for p in patterns)
+
+
+def compiled():
+    for field in FIELDS:
+        is_field_indexed(field)
+
+
+def main():
+    config['ckanext.extractor.indexed_fields'] = PATTERNS
+    old = min(timeit.repeat(uncompiled, number=1000, repeat=3))
+    new = min(timeit.repeat(compiled, number=1000, repeat=3))
+    print('Pattern matching: {:.1f}ms uncompiled, {:.1f}ms compiled '
+          '({:.1f}x speedup)'.format(old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,10 +19,13 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
-from fnmatch import fnmatch
+from fnmatch import translate
+import logging
 import logging.config
 import os.path
+import re
 from string import lower
+import time
 
 import paste.deploy
 from paste.registry import Registry
@@ -33,14 +36,44 @@ from ckan.config.environment import load_environment
 from ckan.lib.cli import MockTranslator
 
 
+log = logging.getLogger(__name__)
+
 DEFAULTS = {
     'ckanext.extractor.indexed_formats': 'pdf',
     'ckanext.extractor.indexed_fields': 'fulltext',
+    'ckanext.extractor.backend': 'solr',
+    'ckanext.extractor.storage': 'table',
+    'ckanext.extractor.queue': 'rq',
+    'ckanext.extractor.high_priority_queue': 'default',
+    'ckanext.extractor.low_priority_queue': 'default',
+    'ckanext.extractor.task_lease': '300',
+    'ckanext.extractor.queued_task_lease': '86400',
+    'ckanext.extractor.download_pool_size': '10',
+    'ckanext.extractor.download_keep_alive': 'true',
+    'ckanext.extractor.memory_buffer_size': '10485760',
+    'ckanext.extractor.connect_timeout': '10',
+    'ckanext.extractor.read_timeout': '60',
+    'ckanext.extractor.job_timeout': '150',
+    'ckanext.extractor.max_file_size': '0',
 }
 
 TRANSFORMATIONS = {
     'ckanext.extractor.indexed_formats': [lower, toolkit.aslist],
     'ckanext.extractor.indexed_fields': [lower, toolkit.aslist],
+    'ckanext.extractor.backend': [],
+    'ckanext.extractor.storage': [lower],
+    'ckanext.extractor.queue': [lower],
+    'ckanext.extractor.high_priority_queue': [],
+    'ckanext.extractor.low_priority_queue': [],
+    'ckanext.extractor.task_lease': [int],
+    'ckanext.extractor.queued_task_lease': [int],
+    'ckanext.extractor.download_pool_size': [int],
+    'ckanext.extractor.download_keep_alive': [toolkit.asbool],
+    'ckanext.extractor.memory_buffer_size': [int],
+    'ckanext.extractor.connect_timeout': [float],
+    'ckanext.extractor.read_timeout': [float],
+    'ckanext.extractor.job_timeout': [float],
+    'ckanext.extractor.max_file_size': [int],
 }
 
 
@@ -60,15 +93,30 @@ def get(setting):
     return value
 
 
+# Path of the configuration file that has been loaded in this process
+_loaded_ini_path = None
+
+
 # Adapted from ckanext-archiver
 def load_config(ini_path):
     """
     Load CKAN configuration.
+
+    Loading the CKAN environment is expensive, so it is only done once
+    per process and configuration file. Subsequent calls only register
+    the translator for the current thread.
     """
+    global _loaded_ini_path
     ini_path = os.path.abspath(ini_path)
-    logging.config.fileConfig(ini_path, disable_existing_loggers=False)
-    conf = paste.deploy.appconfig('config:' + ini_path)
-    load_environment(conf.global_conf, conf.local_conf)
+    if ini_path != _loaded_ini_path:
+        start = time.time()
+        logging.config.fileConfig(ini_path, disable_existing_loggers=False)
+        conf = paste.deploy.appconfig('config:' + ini_path)
+        load_environment(conf.global_conf, conf.local_conf)
+        _loaded_ini_path = ini_path
+        _matchers.clear()
+        log.debug('Loaded CKAN configuration from "{}" in {:.3f}s'.format(
+                  ini_path, time.time() - start))
     _register_translator()
 
 
@@ -91,23 +139,87 @@ def _register_translator():
     registry.register(translator, translator_obj)
 
 
-def _any_match(s, patterns):
+# Compiled matchers for the pattern settings. Maps the names of the
+# settings to tuples containing the raw setting value from which the
+# matcher has been compiled and the matcher itself.
+_matchers = {}
+
+# Maximum number of memoized results per matcher
+MATCHER_CACHE_SIZE = 10000
+
+
+def _compile_matcher(patterns):
+    """
+    Compile shell-style patterns into a matching function.
+
+    All patterns are combined into a single regular expression. The
+    returned function takes a string and checks whether it matches at
+    least one of the patterns. Its results are memoized.
+    """
+    if patterns:
+        regex = re.compile('|'.join('(?:{})'.format(translate(pattern))
+                           for pattern in patterns))
+    else:
+        regex = None
+    results = {}
+
+    def matcher(s):
+        try:
+            return results[s]
+        except KeyError:
+            pass
+        if len(results) >= MATCHER_CACHE_SIZE:
+            results.clear()
+        result = results[s] = bool(regex and regex.match(s.lower()))
+        return result
+
+    return matcher
+
+
+def _get_matcher(setting):
     """
-    Check if a string matches at least one pattern.
+    Get the matching function for a pattern setting.
+
+    The matcher is compiled on first use and re-compiled whenever the
+    value of the setting changes.
     """
-    return any(fnmatch(s, pattern) for pattern in patterns)
+    raw = config.get('ckanext.extractor.' + setting,
+                     DEFAULTS['ckanext.extractor.' + setting])
+    try:
+        cached_raw, matcher = _matchers[setting]
+        if cached_raw == raw:
+            return matcher
+    except KeyError:
+        pass
+    matcher = _compile_matcher(get(setting))
+    _matchers[setting] = (raw, matcher)
+    return matcher
 
 
 def is_field_indexed(field):
     """
     Check if a metadata field is configured to be indexed.
     """
-    return _any_match(field.lower(), get('indexed_fields'))
+    return _get_matcher('indexed_fields')(field)
 
 
 def is_format_indexed(format):
     """
     Check if a resource format is configured to be indexed.
     """
-    return _any_match(format.lower(), get('indexed_formats'))
+    return _get_matcher('indexed_formats')(format)
 
+
+def get_queue_names():
+    """
+    Get the names of the job queues in the order of their priority.
+
+    Returns a list with the names of the high and the low priority
+    queue. If both settings use the same name then it is only included
+    once.
+    """
+    names = [get('high_priority_queue')]
+    low = get('low_priority_queue')
+    if low not in names:
+        names.append(low)
+    return names
@@ -71,7 +71,11 @@ class IExtractorPostprocessor(plugins.Interface):
         Postprocess metadata after it has been indexed.
 
         Called after the package of the resource whose metadata has been
-        extracted has been re-indexed after the extraction.
+        extracted has been re-indexed after the extraction. Note that
+        the re-indexing of a package is delayed and combined for
+        multiple extractions of the package's resources when running
+        in a background job, so this hook may be called some time after
+        ``extractor_after_save``.
 
         ``resource_dict`` and ``metadata_dict`` are dict-representations
         of the resource and the metadata, respectively. Changes to them
@@ -104,3 +108,40 @@ class IExtractorRequest(plugins.Interface):
         <http://docs.python-requests.org/en/master/user/advanced/>`_.
         '''
         return request
+
+
+class IExtractorBackend(plugins.Interface):
+    '''
+    Provide additional extraction backends.
+
+    An extraction backend is a function that extracts text and metadata
+    from a file. *ckanext-extractor* comes with the ``solr`` and
+    ``python`` backends, this interface allows you to provide others.
+    The backend that is used is chosen via the
+    ``ckanext.extractor.backend`` configuration option.
+    '''
+    def extractor_get_backends(self):
+        '''
+        Return the extraction backends provided by the plugin.
+
+        Must return a dict that maps backend names to backend functions.
+        A backend function is called as
+
+            extract(chunks, deadline, content_type, file_name)
+
+        ``chunks`` is an iterable of byte strings that make up the
+        file's content. ``deadline`` is a UNIX timestamp by which the
+        extraction should be finished; backends should raise
+        ``ckanext.extractor.lib.LimitExceeded`` if it is exceeded.
+        ``content_type`` and ``file_name`` are hints for detecting the
+        file format and may be ``None``.
+
+        The function must return a dict that maps metadata field names
+        to their values. The extracted text must be stored in the
+        ``fulltext`` field. The field names are normalized afterwards
+        (see ``ckanext.extractor.lib.clean_metadatum``).
+
+        If the extraction fails then the function should raise
+        ``ckanext.extractor.lib.ExtractionError``.
+        '''
+        return {}
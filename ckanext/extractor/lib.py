@@ -19,37 +19,484 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+from cookielib import DefaultCookiePolicy
 import datetime
+import hashlib
+import logging
+import os
+import socket
 import tempfile
+import threading
+import time
 
 from ckan.plugins import PluginImplementations
-from .interfaces import IExtractorRequest
+from .config import get as get_config
+from .interfaces import IExtractorBackend, IExtractorRequest
 
 from pylons import config
-import pysolr
 from requests import Request, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout
 
 
-def download_and_extract(resource_url):
+log = logging.getLogger(__name__)
+
+# Size of the chunks in which files are downloaded and uploaded
+CHUNK_SIZE = 64 * 1024
+
+# HTTP session and the ID of the process it belongs to
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Get the HTTP session for downloading resources.
+
+    The session is also used for the requests to Solr. The session and
+    its connection pools are shared by all requests in the current
+    process, so that connections to the same host can be reused. The
+    number of connections that are kept per host can be configured via
+    ``ckanext.extractor.download_pool_size``.
+
+    Cookies are not stored, so that state from one resource's server
+    cannot leak into the requests for other resources.
+    """
+    global _session, _session_pid
+    # Connections must not be shared with forked processes
+    if _session is None or _session_pid != os.getpid():
+        pool_size = get_config('download_pool_size')
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        _session = Session()
+        # Block all cookies
+        _session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+class Heartbeat(object):
+    """
+    Context manager that regularly calls a function in a background thread.
+
+    ``fn`` is called when the context is entered and then every
+    ``interval`` seconds until the context is left, even while the main
+    thread is blocked (for example by a download or an extraction).
+    Exceptions raised by ``fn`` are logged.
+    """
+    def __init__(self, fn, interval):
+        self.fn = fn
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._beat()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._beat()
+
+    def _beat(self):
+        try:
+            self.fn()
+        except Exception:
+            log.exception('Heartbeat failed')
+
+
+class ResourceUnchanged(Exception):
+    """
+    Raised if a resource's file has not changed since the last download.
+
+    The ``download`` attribute contains the information about the
+    download (see :py:func:`download_and_extract`).
+    """
+    def __init__(self, download):
+        super(ResourceUnchanged, self).__init__('Resource is unchanged')
+        self.download = download
+
+
+class ExtractionError(Exception):
+    """
+    Raised if the extraction of a resource's file fails.
+    """
+    pass
+
+
+class LimitExceeded(ExtractionError):
+    """
+    Raised if a download or extraction exceeds a configured limit.
     """
-    Download resource and extract metadata using Solr.
+    pass
 
-    The extracted metadata is cleaned and returned.
+
+def download_and_extract(resource_url, previous=None):
     """
-    session = Session()
+    Download resource and extract metadata.
+
+    The extraction is done by the backend configured via
+    ``ckanext.extractor.backend`` (see :py:func:`get_backend`).
+
+    ``previous`` is an optional dict containing the information about
+    the previous download of the resource, as returned by an earlier
+    call of this function.
+
+    Returns a tuple ``(metadata, download)``, where ``metadata`` is a
+    dict with the cleaned metadata and ``download`` is a dict with
+    information about the download:
+
+    :url: The URL of the resource
+    :hash: The SHA-256 hash of the downloaded file
+    :etag: The value of the response's ``ETag`` header (or ``None``)
+    :last_modified: The value of the response's ``Last-Modified``
+        header (or ``None``)
+    :size: The number of bytes that have been downloaded
+
+    If the resource URL is unchanged then the ``ETag`` and
+    ``Last-Modified`` values of the previous download are used to make
+    a conditional request. If the server reports that the file has not
+    been modified, or if the downloaded file has the same hash as the
+    previous download, then no extraction is performed and
+    ``ResourceUnchanged`` is raised instead.
+
+    If there is no previous download to compare with then the file is
+    streamed directly from the remote server to the extraction backend.
+    Otherwise it has to be downloaded completely before it can be
+    compared. In that case it is buffered in memory unless it is larger
+    than ``ckanext.extractor.memory_buffer_size``.
+
+    ``LimitExceeded`` is raised if the file is larger than
+    ``ckanext.extractor.max_file_size`` or if downloading and extracting
+    takes longer than ``ckanext.extractor.job_timeout``.
+    """
+    deadline = time.time() + get_config('job_timeout')
+    previous = previous or {}
+    extract = get_backend()
+    session = get_session()
     request = Request('GET', resource_url).prepare()
+    if not get_config('download_keep_alive'):
+        request.headers['Connection'] = 'close'
+    if previous.get('hash') and previous.get('url') == resource_url:
+        if previous.get('etag'):
+            request.headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            request.headers['If-Modified-Since'] = previous['last_modified']
     for plugin in PluginImplementations(IExtractorRequest):
         request = plugin.extractor_before_request(request)
-    with tempfile.NamedTemporaryFile() as f:
-        r = session.send(request, stream=True)
+    r = session.send(request, stream=True, timeout=_get_timeouts(deadline))
+    watchdog = _start_watchdog(r, deadline)
+    try:
         r.raise_for_status()
-        for chunk in r.iter_content(chunk_size=1024):
+        download = {
+            'url': resource_url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'size': 0,
+        }
+        if r.status_code == 304:
+            download['hash'] = previous['hash']
+            download['etag'] = download['etag'] or previous.get('etag')
+            download['last_modified'] = (download['last_modified'] or
+                                         previous.get('last_modified'))
+            raise ResourceUnchanged(download)
+        max_size = get_config('max_file_size')
+        content_length = r.headers.get('Content-Length')
+        if max_size and content_length and int(content_length) > max_size:
+            raise LimitExceeded('File size of {} bytes exceeds the limit of '
+                                .format(content_length) + '{} bytes'.format(
+                                max_size))
+        content_type = r.headers.get('Content-Type')
+        file_name = resource_url.rstrip('/').rsplit('/', 1)[-1]
+        file_hash = hashlib.sha256()
+        chunks = _hashed(_limited(r.iter_content(chunk_size=CHUNK_SIZE),
+                                  max_size, deadline), file_hash, download)
+        if not previous.get('hash'):
+            extracted = extract(chunks, deadline, content_type, file_name)
+            # Make sure that the hash covers the whole file even if the
+            # backend did not read all of it
+            for _ in chunks:
+                pass
+            download['hash'] = file_hash.hexdigest()
+        else:
+            buffer_size = get_config('memory_buffer_size')
+            with tempfile.SpooledTemporaryFile(max_size=buffer_size) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                download['hash'] = file_hash.hexdigest()
+                if download['hash'] == previous['hash']:
+                    raise ResourceUnchanged(download)
+                f.seek(0)
+                chunks = iter(lambda: f.read(CHUNK_SIZE), b'')
+                extracted = extract(chunks, deadline, content_type, file_name)
+    finally:
+        watchdog.cancel()
+        r.close()
+    metadata = dict(clean_metadatum(*x) for x in extracted.iteritems())
+    return metadata, download
+
+
+def get_backend(name=None):
+    """
+    Get an extraction backend.
+
+    ``name`` is the name of the backend. If it is not given then the
+    backend configured via ``ckanext.extractor.backend`` is returned.
+
+    Besides the built-in ``solr`` and ``python`` backends, additional
+    backends can be provided by plugins that implement
+    :py:class:`ckanext.extractor.interfaces.IExtractorBackend`.
+
+    Raises a ``ValueError`` if there is no backend with the given name.
+    """
+    backends = {
+        'python': extract_with_python,
+        'solr': extract_with_solr,
+    }
+    for plugin in PluginImplementations(IExtractorBackend):
+        backends.update(plugin.extractor_get_backends())
+    name = name or get_config('backend')
+    try:
+        return backends[name]
+    except KeyError:
+        raise ValueError('Unknown extraction backend "{}".'.format(name))
+
+
+def _hashed(chunks, file_hash, download):
+    """
+    Update a hash with the chunks of a file while passing them on.
+
+    ``chunks`` is an iterable of byte strings and ``file_hash`` is a
+    ``hashlib`` hash object. Returns a generator that yields the chunks.
+
+    The total size of the chunks is stored in the ``size`` entry of the
+    ``download`` dict.
+    """
+    for chunk in chunks:
+        file_hash.update(chunk)
+        download['size'] += len(chunk)
+        yield chunk
+
+
+def _limited(chunks, max_size, deadline):
+    """
+    Enforce size and time limits while reading the chunks of a file.
+
+    ``chunks`` is an iterable of byte strings. Returns a generator that
+    yields the chunks and raises ``LimitExceeded`` as soon as their
+    total size exceeds ``max_size`` (unless that is zero) or the
+    current time is after ``deadline`` (a UNIX timestamp).
+
+    Reading errors and premature ends of the file after the deadline
+    (for example caused by :py:func:`_start_watchdog`) are reported as
+    ``LimitExceeded``, too.
+    """
+    size = 0
+    chunks = iter(chunks)
+    while True:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        except Exception:
+            if time.time() > deadline:
+                raise LimitExceeded('Time limit exceeded during download')
+            raise
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise LimitExceeded('File size exceeds the limit of {} bytes'
+                                .format(max_size))
+        if time.time() > deadline:
+            raise LimitExceeded('Time limit exceeded during download')
+        yield chunk
+    if time.time() > deadline:
+        raise LimitExceeded('Time limit exceeded during download')
+
+
+def _start_watchdog(response, deadline):
+    """
+    Abort a streamed download once a deadline has passed.
+
+    The read timeout of a request only limits the time between two
+    packets, so a server that sends its data very slowly could keep a
+    download running far beyond ``deadline`` (a UNIX timestamp). The
+    returned ``threading.Timer`` therefore shuts down the response's
+    socket at the deadline, which makes any blocked read return. Call
+    its ``cancel`` method once the response is no longer read.
+    """
+    watchdog = threading.Timer(max(deadline - time.time(), 0),
+                               _abort_download, [response])
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
+
+
+def _abort_download(response):
+    """
+    Shut down the socket of a streamed response.
+    """
+    log.debug('Aborting download of {}'.format(response.url))
+    connection = getattr(response.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        # Socket has been closed in the meantime
+        pass
+
+
+def _get_timeouts(deadline):
+    """
+    Get the connect and read timeouts for an HTTP request.
+
+    The read timeout is reduced if necessary so that it does not extend
+    beyond ``deadline`` (a UNIX timestamp).
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise LimitExceeded('Time limit exceeded')
+    connect_timeout = min(get_config('connect_timeout'), remaining)
+    read_timeout = min(get_config('read_timeout'), remaining)
+    return connect_timeout, read_timeout
+
+
+def extract_with_solr(chunks, deadline, content_type=None, file_name=None):
+    """
+    Extract text and metadata from a file using Solr.
+
+    This is the ``solr`` extraction backend, see
+    :py:class:`ckanext.extractor.interfaces.IExtractorBackend` for a
+    description of the arguments and the return value.
+
+    The chunks are streamed to Solr, so Solr's extraction can start
+    while the file is still being read. ``content_type`` and
+    ``file_name`` are passed to Solr as hints for detecting the file
+    format.
+    """
+    url = config['solr_url'].rstrip('/') + '/update/extract'
+    params = {
+        'extractOnly': 'true',
+        'extractFormat': 'text',
+        'wt': 'json',
+    }
+    if file_name:
+        params['resource.name'] = file_name
+    headers = {'Content-Type': content_type or 'application/octet-stream'}
+    # Solr only responds once the extraction is complete, so the read
+    # timeout is limited by the deadline instead of the usual setting.
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise LimitExceeded('Time limit exceeded')
+    timeout = (min(get_config('connect_timeout'), remaining), remaining)
+    try:
+        r = get_session().post(url, params=params, data=chunks,
+                               headers=headers, timeout=timeout)
+    except Timeout:
+        raise LimitExceeded('Time limit exceeded during extraction')
+    if not r.ok:
+        raise ExtractionError('Solr responded with status {}: {}'.format(
+                              r.status_code, r.text))
+    # Solr's response contains the content and the metadata using keys
+    # based on the name of the content stream. The metadata is a flat
+    # list of alternating keys and value lists.
+    metadata = {}
+    contents = None
+    for key, value in r.json().items():
+        if key == 'responseHeader':
+            continue
+        elif key.endswith('_metadata'):
+            metadata = dict(zip(value[::2], value[1::2]))
+        else:
+            contents = value
+    metadata['fulltext'] = contents
+    return metadata
+
+
+# Mapping of the entries of a PDF's document information dictionary to
+# the names of the corresponding fields reported by Solr.
+PDF_INFO_FIELDS = {
+    '/Author': 'author',
+    '/CreationDate': 'created',
+    '/Creator': 'xmp:creatortool',
+    '/Keywords': 'keywords',
+    '/ModDate': 'last-modified',
+    '/Producer': 'producer',
+    '/Subject': 'subject',
+    '/Title': 'title',
+}
+
+
+def extract_with_python(chunks, deadline, content_type=None, file_name=None):
+    """
+    Extract text and metadata from a file within the current process.
+
+    This is the ``python`` extraction backend, see
+    :py:class:`ckanext.extractor.interfaces.IExtractorBackend` for a
+    description of the arguments and the return value.
+
+    Supports PDF files (which requires the PyPDF2 package) and plain
+    text files. The fields are named like the corresponding fields
+    reported by Solr, but fewer fields are available.
+    """
+    buffer_size = get_config('memory_buffer_size')
+    with tempfile.SpooledTemporaryFile(max_size=buffer_size) as f:
+        for chunk in chunks:
             f.write(chunk)
-        f.flush()
         f.seek(0)
-        data = pysolr.Solr(config['solr_url']).extract(f, extractFormat='text')
-    data['metadata']['fulltext'] = data['contents']
-    return dict(clean_metadatum(*x) for x in data['metadata'].iteritems())
+        mime_type = (content_type or '').split(';')[0].strip().lower()
+        is_pdf = f.read(5) == b'%PDF-'
+        f.seek(0)
+        if is_pdf:
+            return _extract_pdf(f, deadline)
+        elif mime_type.startswith('text/'):
+            text = f.read().decode('utf-8', 'replace')
+            return {'content-type': content_type, 'fulltext': text}
+    raise ExtractionError('The "python" extraction backend does not support '
+                          + 'files of type "{}".'.format(mime_type))
+
+
+def _extract_pdf(f, deadline):
+    """
+    Extract text and metadata from a PDF file using PyPDF2.
+
+    ``f`` is a seekable file-like object containing the PDF.
+    """
+    try:
+        from PyPDF2 import PdfFileReader
+    except ImportError:
+        raise ExtractionError('The "python" extraction backend requires the '
+                              + 'PyPDF2 package for PDF files.')
+    try:
+        reader = PdfFileReader(f, strict=False)
+        if reader.isEncrypted:
+            reader.decrypt('')
+        metadata = {
+            'content-type': 'application/pdf',
+            'xmptpg:npages': unicode(reader.getNumPages()),
+        }
+        for key, value in (reader.getDocumentInfo() or {}).iteritems():
+            key = PDF_INFO_FIELDS.get(key, key.lstrip('/'))
+            metadata[key] = unicode(value.getObject())
+        pages = []
+        for page in reader.pages:
+            if time.time() > deadline:
+                raise LimitExceeded('Time limit exceeded during extraction')
+            pages.append(page.extractText())
+    except LimitExceeded:
+        raise
+    except Exception as e:
+        raise ExtractionError('Could not parse PDF file: {}'.format(e))
+    metadata['fulltext'] = '\n'.join(pages)
+    return metadata
 
 
 def clean_metadatum(key, value):
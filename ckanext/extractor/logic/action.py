@@ -23,20 +23,18 @@ import logging
 
 import ckan.plugins.toolkit as toolkit
 from ckan.logic import validate
+from ckan.model import Package, Resource
+from ckan.model.types import make_uuid
 from pylons import config
+from sqlalchemy import or_
 from sqlalchemy.orm.exc import NoResultFound
 
 from . import schema
 from .helpers import check_access
 from ..model import ResourceMetadata, ResourceMetadatum
-from ..config import is_format_indexed
-from ..tasks import extract
-
-try:
-    enqueue_job = toolkit.enqueue_job
-except AttributeError:
-    # CKAN 2.6 or older
-    from ckanext.rq.jobs import enqueue as enqueue_job
+from ..config import get as get_config, is_format_indexed
+from ..tasks import (cancel_job, enqueue_job, extract, extract_many,
+                     get_job_timeout)
 
 
 log = logging.getLogger(__name__)
@@ -51,6 +49,156 @@ def _get_metadata(resource_id):
             resource=resource_id))
 
 
+def _get_status(resource, metadata):
+    """
+    Determine the extraction status of a resource.
+
+    ``resource`` is a resource dict and ``metadata`` is the resource's
+    ``ResourceMetadata`` instance or ``None``. See ``extractor_extract``
+    for the possible return values.
+    """
+    if metadata is None:
+        if is_format_indexed(resource['format']):
+            return 'new'
+        return 'ignored'
+    if metadata.is_task_alive():
+        return 'inprogress'
+    if not is_format_indexed(resource['format']):
+        return 'ignored'
+    if (metadata.last_url != resource['url']
+            or metadata.last_format != resource['format']):
+        return 'update'
+    return 'unchanged'
+
+
+def _needs_extraction(status, force=False):
+    """
+    Check if a resource with the given status needs to be extracted.
+    """
+    return status in ('new', 'update') or (status != 'ignored' and force)
+
+
+def _get_resources(resource_ids=None, package_id=None):
+    """
+    Load active resources using a single query.
+
+    Returns a list of ``Resource`` instances with the given IDs and/or
+    belonging to the given package.
+    """
+    conditions = []
+    if resource_ids is not None:
+        conditions.append(Resource.id.in_(resource_ids))
+    if package_id is not None:
+        conditions.append(Resource.package_id == package_id)
+    return Resource.Session.query(Resource).filter(
+        or_(*conditions), Resource.state == 'active').all()
+
+
+def _cancel_superseded_jobs(task_ids):
+    """
+    Cancel the jobs of extraction tasks that have been superseded.
+
+    A job is only cancelled if no resource is registered for it anymore,
+    since an ``extract_many`` job may still be responsible for other
+    resources.
+    """
+    ResourceMetadata.Session.flush()
+    for task_id in set(task_ids):
+        if not ResourceMetadata.filter_by(task_id=task_id).count():
+            cancel_job(task_id)
+
+
+def _enqueue_task(fn, args, title, task_id, all_metadata, force=False,
+                  **kwargs):
+    """
+    Enqueue the background job for a registered extraction task.
+
+    The task with ID ``task_id`` must already have been registered in
+    the ``ResourceMetadata`` instances ``all_metadata`` and committed,
+    so that the job cannot start before its registration is visible.
+    The task ID and ``force`` are appended to ``args`` and the task ID
+    is also used as the job's ID. Additional keyword arguments are
+    passed on to ``enqueue_job``.
+
+    If the job cannot be enqueued then the registration is removed.
+    """
+    try:
+        enqueue_job(fn, args + (task_id, force), title=title,
+                    job_id=task_id, **kwargs)
+        # Jobs in the database queue are part of the transaction
+        ResourceMetadata.Session.commit()
+    except Exception:
+        ResourceMetadata.Session.rollback()
+        ResourceMetadata.release_tasks(all_metadata, task_id)
+        ResourceMetadata.Session.commit()
+        raise
+
+
+def _schedule_extractions(resources, force=False, queue_name=None,
+                          enqueue=True):
+    """
+    Schedule the extraction of multiple resources.
+
+    ``resources`` is a list of ``Resource`` instances, see
+    ``_get_resources``. ``queue_name`` is the name of the job queue,
+    it defaults to the high priority queue.
+
+    If ``enqueue`` is false then the task is registered but no job is
+    enqueued. The caller must then extract the resources itself using
+    the task ID (see :py:func:`ckanext.extractor.tasks.extract`).
+
+    Works like ``extractor_extract`` for each resource, but the metadata
+    of all resources are loaded and locked using a single query and all
+    resources that need to be extracted are processed by a single
+    ``extract_many`` background job.
+
+    Returns a tuple ``(results, task_id)``. ``results`` is a dict that
+    maps the resource IDs to dicts with ``status`` and ``task_id``
+    entries as returned by ``extractor_extract``. ``task_id`` is the ID
+    of the new task or ``None`` if no resource needs to be extracted.
+    """
+    # Metadata are only created for resources with indexed formats
+    all_metadata, created = ResourceMetadata.lock_many(
+        [r.id for r in resources],
+        [r.id for r in resources if is_format_indexed(r.format)])
+    results = {}
+    to_extract = []
+    for resource in resources:
+        res_dict = {'url': resource.url, 'format': resource.format}
+        metadata = all_metadata.get(resource.id)
+        status = _get_status(res_dict, None if resource.id in created
+                             else metadata)
+        task_id = None
+        if status == 'inprogress':
+            task_id = metadata.task_id
+        elif status == 'ignored' and metadata is not None:
+            metadata.delete()
+        if _needs_extraction(status, force):
+            to_extract.append(resource.id)
+        results[resource.id] = {'status': status, 'task_id': task_id}
+    if not to_extract:
+        ResourceMetadata.Session.commit()
+        return results, None
+    task_id = make_uuid()
+    superseded = []
+    for resource_id in to_extract:
+        metadata = all_metadata[resource_id]
+        if metadata.task_id is not None:
+            superseded.append(metadata.task_id)
+        metadata.set_task(task_id, get_config('queued_task_lease'))
+        results[resource_id]['task_id'] = task_id
+    _cancel_superseded_jobs(superseded)
+    ResourceMetadata.Session.commit()
+    if not enqueue:
+        return results, task_id
+    title = 'Metadata extraction for {} resources'.format(len(to_extract))
+    _enqueue_task(extract_many, (config['__file__'], to_extract), title,
+                  task_id, [all_metadata[id] for id in to_extract], force,
+                  queue_name=queue_name,
+                  timeout=get_job_timeout(len(to_extract)))
+    return results, task_id
+
+
 @check_access('extractor_delete')
 @validate(schema.extractor_delete)
 def extractor_delete(context, data_dict):
@@ -71,13 +219,18 @@ def extractor_extract(context, data_dict):
     Extract and store metadata for a resource.
 
     Metadata extraction is done in an asynchronous background job, so
-    this function may return before extraction is complete.
+    this function may return before extraction is complete. If there
+    are concurrent requests for the same resource then only one of them
+    schedules a job, the others report it as ``inprogress``.
 
     :param string id: The ID or name of the resource
 
     :param boolean force: Extract metadata even if the resource hasn't
         changed, or if an extraction task is already scheduled for the
-        resource (optional).
+        resource (optional). In the latter case the new task supersedes
+        the existing one, which skips the resource if it hasn't started
+        yet. The file is extracted even if it is identical to the one
+        from the previous extraction.
 
     :rtype: A dict with the following keys:
 
@@ -93,7 +246,11 @@ def extractor_extract(context, data_dict):
                     change since the last extraction)
 
                 :inprogress: if a background extraction task for this
-                    resource is already in progress
+                    resource is already in progress. Tasks whose lease
+                    has expired are considered dead and are ignored.
+                    Since a task reads the resource's current data
+                    when it starts, changes to the resource while the
+                    task is still queued are picked up by that task.
 
                 :ignored: if the resource format is configured to be
                     ignored
@@ -115,41 +272,122 @@ def extractor_extract(context, data_dict):
     force = data_dict.get('force', False)
     resource = toolkit.get_action('resource_show')(context, data_dict)
     task_id = None
-    metadata = None
-    try:
-        metadata = ResourceMetadata.one(resource_id=resource['id'])
-        if metadata.task_id:
-            status = 'inprogress'
-            task_id = metadata.task_id
-        elif not is_format_indexed(resource['format']):
-            metadata.delete()
-            metadata.commit()
-            metadata = None
-            status = 'ignored'
-        elif (metadata.last_url != resource['url']
-              or metadata.last_format != resource['format']):
-            status = 'update'
-        else:
-            status = 'unchanged'
-    except NoResultFound:
-        if is_format_indexed(resource['format']):
-            status = 'new'
-        else:
-            status = 'ignored'
-    if status in ('new', 'update') or (status != 'ignored' and force):
-        args = (config['__file__'], resource)
-        title = 'Metadata extraction for resource {}'.format(resource['id'])
-        if metadata is None:
-            metadata = ResourceMetadata.create(resource_id=resource['id'])
-        job = enqueue_job(extract, args, title=title)
-        task_id = metadata.task_id = job.id
-        metadata.save()
+    # The metadata stay locked until the commit below, so concurrent
+    # requests for the same resource cannot register duplicate tasks.
+    create_ids = [resource['id']] if is_format_indexed(
+        resource['format']) else []
+    all_metadata, created = ResourceMetadata.lock_many([resource['id']],
+                                                       create_ids)
+    metadata = all_metadata.get(resource['id'])
+    status = _get_status(resource, None if created else metadata)
+    if status == 'inprogress':
+        task_id = metadata.task_id
+    elif status == 'ignored' and metadata is not None:
+        metadata.delete()
+    if not _needs_extraction(status, force):
+        ResourceMetadata.Session.commit()
+        return {
+            'status': status,
+            'task_id': task_id,
+        }
+    old_task_id = metadata.task_id
+    task_id = make_uuid()
+    metadata.set_task(task_id, get_config('queued_task_lease'))
+    if old_task_id is not None:
+        _cancel_superseded_jobs([old_task_id])
+    ResourceMetadata.Session.commit()
+    title = 'Metadata extraction for resource {}'.format(resource['id'])
+    _enqueue_task(extract, (config['__file__'], resource), title, task_id,
+                  [metadata], force, timeout=get_job_timeout(1))
     return {
         'status': status,
         'task_id': task_id,
     }
 
 
+@check_access('extractor_extract_many')
+@validate(schema.extractor_extract_many)
+def extractor_extract_many(context, data_dict):
+    """
+    Extract and store metadata for multiple resources.
+
+    Works like ``extractor_extract`` for each resource, but the status
+    of all resources is determined using a single query and all
+    resources that need to be extracted are processed by a single
+    background job.
+
+    :param list ids: The IDs of the resources (optional). Can also be a
+        string with comma-separated IDs.
+
+    :param string package_id: The ID or name of a package whose
+        resources should be extracted (optional).
+
+    :param boolean force: See ``extractor_extract``.
+
+    :param string priority: The priority of the extraction job, either
+        ``high`` or ``low`` (optional, defaults to ``low``). The job is
+        added to the corresponding queue, see the settings
+        ``ckanext.extractor.high_priority_queue`` and
+        ``ckanext.extractor.low_priority_queue``.
+
+    :param string queue: The name of the queue to which the extraction
+        job is added (optional). Overrides ``priority``.
+
+    At least one of ``ids`` and ``package_id`` must be given.
+
+    If the context contains ``enqueue: False`` then the extraction task
+    is registered but no background job is enqueued. The caller is then
+    responsible for extracting the resources using the task's ID (see
+    :py:func:`ckanext.extractor.tasks.extract`).
+
+    :rtype: A dict with the following keys:
+
+        :results: A dict that maps the resource IDs to dicts with the
+            ``status`` and ``task_id`` entries described for
+            ``extractor_extract``.
+
+        :not_found: A list with the IDs of resources that don't exist.
+
+        :task_id: The ID of the new extraction task, or ``null`` if
+            none of the resources needs to be extracted.
+    """
+    log.debug('extractor_extract_many')
+    ids, package_id = _get_ids_and_package_id(data_dict)
+    resources = _get_resources(ids, package_id)
+    queue_name = data_dict.get('queue') or get_config(
+        '{}_priority_queue'.format(data_dict['priority']))
+    results, task_id = _schedule_extractions(
+        resources, data_dict.get('force', False), queue_name,
+        context.get('enqueue', True))
+    return {
+        'results': results,
+        'not_found': [id for id in (ids or []) if id not in results],
+        'task_id': task_id,
+    }
+
+
+def _get_ids_and_package_id(data_dict):
+    """
+    Get the resource IDs and the package ID for a bulk action.
+
+    Raises a ``ValidationError`` if neither is given and an
+    ``ObjectNotFound`` error if the package does not exist. The package
+    ID is returned even if the package was specified using its name.
+    """
+    if 'ids' not in data_dict and 'package_id' not in data_dict:
+        raise toolkit.ValidationError({'ids': [
+            toolkit._('Either "ids" or "package_id" is required.')]})
+    package_id = None
+    if 'package_id' in data_dict:
+        package = Package.get(data_dict['package_id'])
+        if package is None:
+            raise toolkit.ObjectNotFound(
+                toolkit._("Package '{package}' does not exist.").format(
+                package=data_dict['package_id']))
+        package_id = package.id
+    return data_dict.get('ids'), package_id
+
+
 @toolkit.side_effect_free
 @check_access('extractor_list')
 @validate(schema.extractor_list)
@@ -157,13 +395,44 @@ def extractor_list(context, data_dict):
     """
     List resources that have metadata.
 
-    Returns a list with the IDs of the resources which have metadata
-    associated with them.
+    Returns the IDs of the resources which have metadata associated with
+    them. The IDs are sorted and returned in pages.
+
+    :param int limit: The maximum number of IDs to return (optional,
+        between 1 and 1000, defaults to 1000).
+
+    :param string cursor: Only return IDs that come after this value
+        (optional). Pass the ``next_cursor`` value of the previous
+        result to get the next page.
+
+    :rtype: A dict with the following keys:
+
+        :count: The total number of resources with metadata.
+
+        :results: A list with the resource IDs of the current page.
 
-    :rtype: list
+        :next_cursor: The value to pass as ``cursor`` to get the next
+            page, or ``null`` if this is the last page.
     """
     log.debug('extractor_list')
-    return [m.resource_id for m in ResourceMetadata.filter_by(task_id=None)]
+    limit = data_dict['limit']
+    resource_id = ResourceMetadata.resource_id
+    query = ResourceMetadata.Session.query(resource_id).filter(
+        ResourceMetadata.task_id == None)
+    count = query.count()
+    if 'cursor' in data_dict:
+        query = query.filter(resource_id > data_dict['cursor'])
+    # Fetch one additional ID to find out whether there is a next page
+    ids = [row[0] for row in query.order_by(resource_id).limit(limit + 1)]
+    next_cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_cursor = ids[-1]
+    return {
+        'count': count,
+        'results': ids,
+        'next_cursor': next_cursor,
+    }
 
 
 @toolkit.side_effect_free
@@ -175,11 +444,84 @@ def extractor_show(context, data_dict):
 
     :param string id: The ID or name of the resource
 
+    :param list fields: The keys of the metadata fields to return
+        (optional, defaults to all fields). Can also be a string with
+        comma-separated keys. Other fields are not loaded from the
+        database.
+
+    :param int truncate: Shorten the values of the metadata fields to at
+        most this many characters (optional).
+
+    :param boolean length_only: Return the lengths of the values of the
+        metadata fields instead of the values (optional).
+
     :rtype: dict
     """
     log.debug('extractor_show {}'.format(data_dict['id']))
     metadata = _get_metadata(data_dict['id'])
-    result = metadata.as_dict()
-    result['meta'] = dict(metadata.meta)
-    return result
+    return metadata.as_dict(keys=data_dict.get('fields'),
+                            truncate=data_dict.get('truncate'),
+                            length_only=data_dict.get('length_only', False))
+
+
+@toolkit.side_effect_free
+@check_access('extractor_show_many')
+@validate(schema.extractor_show_many)
+def extractor_show_many(context, data_dict):
+    """
+    Show the stored metadata for multiple resources.
+
+    The metadata of all resources are loaded at once, which is much
+    faster than calling ``extractor_show`` for each resource.
+
+    :param list ids: The IDs of the resources (optional). Can also be a
+        string with comma-separated IDs.
+
+    :param string package_id: The ID or name of a package whose
+        resources should be included (optional).
 
+    :param list fields: See ``extractor_show``.
+
+    :param int truncate: See ``extractor_show``.
+
+    :param boolean length_only: See ``extractor_show``.
+
+    At least one of ``ids`` and ``package_id`` must be given.
+
+    :rtype: A dict with the following keys:
+
+        :results: A dict that maps the resource IDs to their metadata in
+            the format returned by ``extractor_show``.
+
+        :not_found: A list with the IDs of the resources for which no
+            metadata exist.
+    """
+    log.debug('extractor_show_many')
+    ids, package_id = _get_ids_and_package_id(data_dict)
+    ids = list(ids or [])
+    if package_id is not None:
+        package = Package.get(package_id)
+        ids.extend(r.id for r in package.resources if r.id not in ids)
+    options = {
+        'keys': data_dict.get('fields'),
+        'truncate': data_dict.get('truncate'),
+        'length_only': data_dict.get('length_only', False),
+    }
+    select_meta = (options['keys'] is not None or options['length_only']
+                   or options['truncate'] is not None)
+    all_metadata = ResourceMetadata.get_many(ids, load_meta=not select_meta)
+    if select_meta:
+        all_meta = ResourceMetadata.get_meta_many(all_metadata, **options)
+    results = {}
+    for resource_id, metadata in all_metadata.iteritems():
+        if select_meta:
+            # Don't load the metadata again for each resource
+            result = metadata.as_dict(keys=[])
+            result['meta'] = all_meta.get(resource_id, {})
+        else:
+            result = metadata.as_dict()
+        results[resource_id] = result
+    return {
+        'results': results,
+        'not_found': [id for id in ids if id not in results],
+    }
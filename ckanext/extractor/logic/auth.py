@@ -38,6 +38,8 @@ def _everybody(context, datadict):
 
 extractor_delete = _only_sysadmins
 extractor_extract = _only_sysadmins
+extractor_extract_many = _only_sysadmins
 extractor_list = _everybody
 extractor_show = _everybody
+extractor_show_many = _everybody
 
@@ -22,13 +22,17 @@ from __future__ import absolute_import, print_function, unicode_literals
 from inspect import getmembers
 import logging
 
-from ckan.lib.navl.validators import ignore_missing, not_empty
-from ckan.logic.schema import default_pagination_schema
-from ckan.logic.validators import boolean_validator
+from ckan.lib.navl.validators import default, ignore_missing, not_empty
+from ckan.logic.validators import (boolean_validator, list_of_strings,
+                                   natural_number_validator)
+from ckan.plugins import toolkit
 
 
 log = logging.getLogger(__name__)
 
+# Maximum number of IDs returned by a single call of ``extractor_list``
+MAX_LIST_LIMIT = 1000
+
 
 class _Schema(object):
     """
@@ -55,6 +59,44 @@ class _Schema(object):
                 key.startswith('__')}
 
 
+def _comma_separated_list(value):
+    """
+    Convert a string with comma-separated values into a list.
+
+    Other values are returned unchanged.
+    """
+    if isinstance(value, basestring):
+        return toolkit.aslist(value, ',')
+    return value
+
+
+def _list_limit(value):
+    """
+    Validate the page size of ``extractor_list``.
+
+    The value must be an integer between 1 and ``MAX_LIST_LIMIT``.
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise toolkit.Invalid(toolkit._('Invalid integer'))
+    if not 1 <= value <= MAX_LIST_LIMIT:
+        raise toolkit.Invalid(toolkit._('Must be between 1 and {}').format(
+                              MAX_LIST_LIMIT))
+    return value
+
+
+def _priority(value):
+    """
+    Validate the priority of extraction jobs.
+
+    The value must be either ``high`` or ``low``.
+    """
+    if value not in ('high', 'low'):
+        raise toolkit.Invalid(toolkit._('Must be "high" or "low"'))
+    return value
+
+
 class _MandatoryID(_Schema):
     id = [not_empty, unicode]
 
@@ -63,6 +105,26 @@ extractor_delete = _MandatoryID
 class extractor_extract(_MandatoryID):
     force = [ignore_missing, boolean_validator]
 
-extractor_list = default_pagination_schema
-extractor_show = _MandatoryID
+class extractor_extract_many(_Schema):
+    ids = [ignore_missing, _comma_separated_list, list_of_strings]
+    package_id = [ignore_missing, unicode]
+    force = [ignore_missing, boolean_validator]
+    priority = [default('low'), unicode, _priority]
+    queue = [ignore_missing, unicode]
+
+class extractor_list(_Schema):
+    limit = [default(MAX_LIST_LIMIT), _list_limit]
+    cursor = [ignore_missing, unicode]
+
+class _MetaSelection(_Schema):
+    fields = [ignore_missing, _comma_separated_list, list_of_strings]
+    truncate = [ignore_missing, natural_number_validator]
+    length_only = [ignore_missing, boolean_validator]
+
+class extractor_show(_MandatoryID, _MetaSelection):
+    pass
+
+class extractor_show_many(_MetaSelection):
+    ids = [ignore_missing, _comma_separated_list, list_of_strings]
+    package_id = [ignore_missing, unicode]
 
@@ -29,21 +29,37 @@ individual metadatum. Using SQLAlchemy's ``association_proxy`` and
 like fashion using the ``ResourceMetadata`` class. This means that you
 will probably never need to use the ``ResourceMetadatum`` class.
 
+Alternatively, if the ``ckanext.extractor.storage`` setting is ``json``,
+all metadata of a resource are stored as a single JSONB document in the
+``meta_json`` column of the ``ResourceMetadata`` table. Both storages
+are accessed via the same ``ResourceMetadata.meta`` dict, and
+:py:func:`migrate_storage` moves existing metadata between them.
+
 In addition to the resource metadata, the class ``ResourceMetadata``
 also stores information about the extraction process.
 """
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import datetime
 import logging
 
-from sqlalchemy import Column, ForeignKey, Table, types
+from sqlalchemy import (and_, Column, ForeignKey, func, Index, inspect, or_,
+                        Table, text, types)
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import relationship
+from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.orm import deferred, joinedload, relationship, undefer
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy.schema import CreateIndex
 
 from ckan.model.domain_object import DomainObject
 from ckan.model.meta import mapper, metadata
+from ckan.model.resource import Resource
+from ckan.model.types import make_uuid
+
+from .config import get as get_config
 
 
 log = logging.getLogger(__name__)
@@ -54,6 +70,12 @@ RESOURCE_METADATUM_TABLE_NAME = 'ckanext_extractor_resource_metadatum'
 resource_metadata_table = None
 RESOURCE_METADATA_TABLE_NAME = 'ckanext_extractor_resource_metadata'
 
+job_table = None
+JOB_TABLE_NAME = 'ckanext_extractor_job'
+
+pending_reindex_table = None
+PENDING_REINDEX_TABLE_NAME = 'ckanext_extractor_pending_reindex'
+
 
 class BaseObject(DomainObject):
     """
@@ -98,8 +120,22 @@ def setup():
             Column('last_extracted', types.DateTime),
             Column('last_url', types.UnicodeText),
             Column('last_format', types.UnicodeText),
-            Column('task_id', types.UnicodeText)
+            Column('last_hash', types.UnicodeText),
+            Column('last_etag', types.UnicodeText),
+            Column('last_modified', types.UnicodeText),
+            Column('last_error', types.UnicodeText),
+            Column('task_id', types.UnicodeText),
+            Column('task_expires', types.DateTime),
+            Column('meta_json', MutableDict.as_mutable(JSONB))
         )
+        # Covers the lookup of finished extractions in ``extractor_list``
+        Index(RESOURCE_METADATA_TABLE_NAME + '_finished_idx',
+              resource_metadata_table.c.resource_id,
+              postgresql_where=resource_metadata_table.c.task_id == None)
+        # Covers the lookup of a task's resources when scheduling tasks
+        Index(RESOURCE_METADATA_TABLE_NAME + '_task_id_idx',
+              resource_metadata_table.c.task_id,
+              postgresql_where=resource_metadata_table.c.task_id != None)
         mapper(
             ResourceMetadata,
             resource_metadata_table,
@@ -107,6 +143,8 @@ def setup():
                 '_meta': relationship(ResourceMetadatum, collection_class=
                                       attribute_mapped_collection('key'),
                                       cascade='all, delete, delete-orphan'),
+                # Only loaded when needed, see ``ResourceMetadata.get_meta``
+                'meta_json': deferred(resource_metadata_table.c.meta_json),
             }
         )
     else:
@@ -124,14 +162,68 @@ def setup():
             Column('key', types.UnicodeText, nullable=False),
             Column('value', types.UnicodeText)
         )
+        Index(RESOURCE_METADATUM_TABLE_NAME + '_resource_id_key_idx',
+              resource_metadatum_table.c.resource_id,
+              resource_metadatum_table.c.key, unique=True)
         mapper(ResourceMetadatum, resource_metadatum_table)
     else:
         log.debug('Resource metadatum table already defined')
+    global job_table
+    if job_table is None:
+        log.debug('Defining job table')
+        job_table = Table(
+            JOB_TABLE_NAME,
+            metadata,
+            Column('id', types.UnicodeText, primary_key=True,
+                   default=make_uuid),
+            Column('created', types.DateTime, nullable=False,
+                   default=datetime.datetime.utcnow),
+            Column('function', types.UnicodeText, nullable=False),
+            Column('args', JSONB, nullable=False),
+            Column('title', types.UnicodeText),
+            Column('queue', types.UnicodeText,
+                   server_default=text("'default'")),
+            Column('claimed', types.DateTime),
+            Column('claim_expires', types.DateTime),
+            Column('worker', types.UnicodeText),
+            Column('unique_key', types.UnicodeText)
+        )
+        # Covers the claiming of the oldest unclaimed job of a queue
+        Index(JOB_TABLE_NAME + '_unclaimed_queue_idx', job_table.c.queue,
+              job_table.c.created,
+              postgresql_where=job_table.c.claimed == None)
+        # Covers the lookup of expired claims
+        Index(JOB_TABLE_NAME + '_claimed_idx', job_table.c.claim_expires,
+              postgresql_where=job_table.c.claimed != None)
+        # Prevents duplicate unclaimed jobs, see ``queue.enqueue_unique``
+        Index(JOB_TABLE_NAME + '_unique_key_idx', job_table.c.unique_key,
+              unique=True, postgresql_where=and_(
+                  job_table.c.claimed == None,
+                  job_table.c.unique_key != None))
+        mapper(QueuedJob, job_table)
+    else:
+        log.debug('Job table already defined')
+    global pending_reindex_table
+    if pending_reindex_table is None:
+        log.debug('Defining pending reindex table')
+        # Resources whose metadata is waiting to be indexed when the
+        # database queue is used, see ``tasks._schedule_reindex``
+        pending_reindex_table = Table(
+            PENDING_REINDEX_TABLE_NAME,
+            metadata,
+            Column('package_id', types.UnicodeText, primary_key=True),
+            Column('resource_id', types.UnicodeText, primary_key=True)
+        )
+    else:
+        log.debug('Pending reindex table already defined')
 
 
 def create_tables():
     """
     Create database tables.
+
+    Tables that already exist are upgraded by adding missing columns and
+    indexes.
     """
     setup()
     if not resource_metadata_table.exists():
@@ -139,11 +231,248 @@ def create_tables():
         resource_metadata_table.create()
     else:
         log.info('Resource metadata table already exists')
+        _add_missing_columns(resource_metadata_table)
+        _add_missing_indexes(resource_metadata_table)
     if not resource_metadatum_table.exists():
         log.info('Creating resource metadatum table')
         resource_metadatum_table.create()
     else:
         log.info('Resource metadatum table already exists')
+        _add_missing_columns(resource_metadatum_table)
+        _remove_duplicate_metadatums()
+        _add_missing_indexes(resource_metadatum_table)
+    if not job_table.exists():
+        log.info('Creating job table')
+        job_table.create()
+    else:
+        log.info('Job table already exists')
+        _add_missing_columns(job_table)
+        _add_missing_indexes(job_table)
+    if not pending_reindex_table.exists():
+        log.info('Creating pending reindex table')
+        pending_reindex_table.create()
+    else:
+        log.info('Pending reindex table already exists')
+
+
+def _add_missing_columns(table):
+    """
+    Add columns that are missing from an existing database table.
+
+    This is used to upgrade the tables of older installations.
+    """
+    engine = metadata.bind
+    existing = set(c['name'] for c in inspect(engine).get_columns(table.name))
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        log.info('Adding column "{}" to table "{}"'.format(column.name,
+                 table.name))
+        column_type = column.type.compile(dialect=engine.dialect)
+        sql = 'ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, column.name,
+                                                      column_type)
+        if column.server_default is not None:
+            sql += ' DEFAULT {}'.format(column.server_default.arg)
+        engine.execute(sql)
+
+
+def _remove_duplicate_metadatums():
+    """
+    Remove duplicate metadatums of the same resource.
+
+    Older versions did not prevent multiple rows with the same key for a
+    resource. Only the most recent of these rows is kept.
+    """
+    engine = metadata.bind
+    result = engine.execute("""
+        DELETE FROM {table} AS a USING {table} AS b
+        WHERE a.resource_id = b.resource_id AND a.key = b.key AND a.id < b.id
+    """.format(table=RESOURCE_METADATUM_TABLE_NAME))
+    if result.rowcount:
+        log.info('Removed {} duplicate metadatums'.format(result.rowcount))
+
+
+def _add_missing_indexes(table):
+    """
+    Add indexes that are missing from an existing database table.
+
+    The indexes are created concurrently, so that writes to the table
+    are not blocked while an index is built.
+    """
+    engine = metadata.bind
+    existing = set(i['name'] for i in inspect(engine).get_indexes(table.name))
+    # Indexes cannot be created concurrently within a transaction
+    connection = engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT')
+    try:
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            log.info('Adding index "{}" to table "{}"'.format(index.name,
+                     table.name))
+            sql = unicode(CreateIndex(index).compile(dialect=engine.dialect))
+            sql = sql.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+            try:
+                connection.execute(sql)
+            except Exception:
+                # A failed concurrent build leaves an invalid index behind
+                connection.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'
+                                   .format(index.name))
+                raise
+    finally:
+        connection.close()
+
+
+def renew_task_leases(resource_ids, duration, task_id=None):
+    """
+    Renew the leases of the extraction tasks of resources.
+
+    The leases of the tasks of the given resources are set to expire
+    ``duration`` seconds from now. Resources without a task are not
+    affected. If ``task_id`` is given then only the resources whose
+    task has that ID are affected.
+
+    The update is executed and committed using a separate database
+    connection, so this function can be called from another thread.
+    """
+    setup()
+    table = resource_metadata_table
+    expires = datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=duration)
+    condition = table.c.task_id != None
+    if task_id is not None:
+        condition = table.c.task_id == task_id
+    metadata.bind.execute(table.update().where(and_(
+        table.c.resource_id.in_(list(resource_ids)),
+        condition)).values(task_expires=expires))
+
+
+def reap_tasks(expired_only=True):
+    """
+    Remove stale extraction tasks.
+
+    Clears the tasks whose leases have expired. If ``expired_only`` is
+    false then all tasks are cleared.
+
+    Returns the number of cleared tasks.
+    """
+    setup()
+    table = resource_metadata_table
+    condition = table.c.task_id != None
+    if expired_only:
+        condition = and_(condition, table.c.task_expires <
+                         datetime.datetime.utcnow())
+    result = metadata.bind.execute(table.update().where(condition).values(
+        task_id=None, task_expires=None))
+    return result.rowcount
+
+
+def add_pending_reindex(package_id, resource_id):
+    """
+    Mark a resource's metadata as waiting to be indexed.
+
+    Like the other database operations this only affects the current
+    transaction, the caller has to commit.
+    """
+    setup()
+    ResourceMetadata.Session.execute(text("""
+        INSERT INTO {table} (package_id, resource_id)
+        VALUES (:package_id, :resource_id)
+        ON CONFLICT DO NOTHING
+    """.format(table=PENDING_REINDEX_TABLE_NAME)),
+        {'package_id': package_id, 'resource_id': resource_id})
+
+
+def get_pending_reindex(package_id):
+    """
+    Get the resources of a package whose metadata wait to be indexed.
+
+    Returns a set of resource IDs.
+    """
+    setup()
+    table = pending_reindex_table
+    result = ResourceMetadata.Session.execute(table.select().where(
+        table.c.package_id == package_id))
+    return set(row.resource_id for row in result)
+
+
+def remove_pending_reindex(package_id, resource_ids):
+    """
+    Mark the metadata of some of a package's resources as indexed.
+
+    The caller has to commit.
+    """
+    setup()
+    table = pending_reindex_table
+    ResourceMetadata.Session.execute(table.delete().where(and_(
+        table.c.package_id == package_id,
+        table.c.resource_id.in_(list(resource_ids)))))
+
+
+def _uses_json_storage():
+    """
+    Check if metadata are stored as JSON documents.
+    """
+    return get_config('storage') == 'json'
+
+
+def _load_meta_options():
+    """
+    Get the query options for eagerly loading the metadata.
+    """
+    if _uses_json_storage():
+        return [undefer('meta_json')]
+    return [joinedload('_meta')]
+
+
+def migrate_storage(storage):
+    """
+    Move the metadata of all resources to a storage.
+
+    ``storage`` is either ``table`` (one row per metadatum) or ``json``
+    (one JSONB document per resource). The metadata are moved using
+    set-based SQL statements in a single transaction. If a resource has
+    metadata in both storages then the ones in the target storage are
+    kept.
+    """
+    setup()
+    metadata_table = RESOURCE_METADATA_TABLE_NAME
+    metadatum_table = RESOURCE_METADATUM_TABLE_NAME
+    if storage == 'json':
+        statements = [
+            """
+            UPDATE {metadata} AS m SET meta_json = (
+                SELECT json_object_agg(d.key, d.value)::jsonb
+                FROM {metadatum} AS d WHERE d.resource_id = m.resource_id
+            )
+            WHERE (m.meta_json IS NULL OR m.meta_json = '{{}}'::jsonb)
+            AND EXISTS (
+                SELECT 1 FROM {metadatum} AS d
+                WHERE d.resource_id = m.resource_id
+            )
+            """,
+            "DELETE FROM {metadatum}",
+        ]
+    elif storage == 'table':
+        statements = [
+            """
+            INSERT INTO {metadatum} (resource_id, key, value)
+            SELECT m.resource_id, e.key, e.value
+            FROM {metadata} AS m, jsonb_each_text(m.meta_json) AS e
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {metadatum} AS d
+                WHERE d.resource_id = m.resource_id
+            )
+            """,
+            "UPDATE {metadata} SET meta_json = NULL",
+        ]
+    else:
+        raise ValueError('Unknown storage "{}".'.format(storage))
+    log.info('Moving metadata to {} storage'.format(storage))
+    with metadata.bind.begin() as connection:
+        for statement in statements:
+            connection.execute(statement.format(metadata=metadata_table,
+                               metadatum=metadatum_table))
 
 
 class ResourceMetadatum(BaseObject):
@@ -159,11 +488,338 @@ class ResourceMetadata(BaseObject):
     """
     A resource's metadata and information about their extraction.
     """
-    meta = association_proxy('_meta', 'value')
+    _meta_proxy = association_proxy('_meta', 'value')
+
+    @property
+    def meta(self):
+        """
+        Dict-like access to the metadata.
+
+        Depending on the ``ckanext.extractor.storage`` setting the
+        metadata are stored in separate rows or as a JSON document.
+        """
+        if _uses_json_storage():
+            if self.meta_json is None:
+                self.meta_json = {}
+            return self.meta_json
+        return self._meta_proxy
+
+    @classmethod
+    def get_many(cls, resource_ids, load_meta=True):
+        """
+        Get the metadata of multiple resources at once.
+
+        ``resource_ids`` is an iterable of resource IDs. The metadata
+        and their individual metadatum rows are loaded using a single
+        query. If ``load_meta`` is false then the individual metadatums
+        are not loaded in advance.
+
+        Returns a dict that maps the resource IDs to their
+        ``ResourceMetadata`` instances. Resources without metadata are
+        not included.
+        """
+        resource_ids = list(resource_ids)
+        if not resource_ids:
+            return {}
+        query = cls.Session.query(cls).filter(
+            cls.resource_id.in_(resource_ids))
+        if load_meta:
+            query = query.options(*_load_meta_options())
+        return {m.resource_id: m for m in query}
+
+    @classmethod
+    def lock_many(cls, resource_ids, create_ids=None):
+        """
+        Get and lock the metadata of multiple resources for an update.
+
+        Missing metadata of the resources in ``create_ids`` (defaults to
+        all of ``resource_ids``) are created using an atomic upsert and
+        all metadata rows are then locked using ``SELECT ... FOR UPDATE``
+        until the end of the current transaction. Concurrent
+        transactions that try to lock the same resources wait until
+        then, so check-then-act sequences like the registration of
+        extraction tasks are race-free, even across multiple CKAN
+        instances that share the database.
+
+        The rows are locked in the order of the resource IDs to avoid
+        deadlocks between concurrent transactions.
+
+        Returns a tuple ``(metadata, created)``. ``metadata`` is a dict
+        that maps the resource IDs to their ``ResourceMetadata``
+        instances (resources without metadata are not included) and
+        ``created`` is the set of the IDs of the resources whose
+        metadata have just been created.
+        """
+        resource_ids = sorted(set(resource_ids))
+        if create_ids is None:
+            create_ids = resource_ids
+        else:
+            create_ids = sorted(set(create_ids))
+        if not resource_ids:
+            return {}, set()
+        created = set()
+        if create_ids:
+            sql = text("""
+                INSERT INTO {table} (resource_id)
+                SELECT unnest(:ids)
+                ON CONFLICT (resource_id) DO NOTHING
+                RETURNING resource_id
+            """.format(table=RESOURCE_METADATA_TABLE_NAME))
+            created = {row[0] for row in
+                       cls.Session.execute(sql, {'ids': create_ids})}
+        query = (cls.Session.query(cls)
+                 .filter(cls.resource_id.in_(resource_ids))
+                 .order_by(cls.resource_id)
+                 .with_for_update()
+                 .populate_existing())
+        return {m.resource_id: m for m in query}, created
+
+    @classmethod
+    def get_many_by_package(cls, package_ids):
+        """
+        Get the metadata of the resources of multiple packages at once.
+
+        ``package_ids`` is an iterable of package IDs. The metadata of
+        all resources of these packages are loaded using a single query.
+
+        Returns a dict that maps each package ID to a dict which in turn
+        maps the package's resource IDs to their metadata dicts.
+        Resources without metadata are not included.
+        """
+        package_ids = list(package_ids)
+        result = {package_id: {} for package_id in package_ids}
+        if not package_ids:
+            return result
+        query = (cls.Session.query(cls, Resource.package_id)
+                 .join(Resource, Resource.id == cls.resource_id)
+                 .filter(Resource.package_id.in_(package_ids))
+                 .options(*_load_meta_options()))
+        for metadata, package_id in query:
+            result[package_id][metadata.resource_id] = dict(metadata.meta)
+        return result
+
+    def set_task(self, task_id, lease):
+        """
+        Register an extraction task.
+
+        ``lease`` is the number of seconds after which the task is
+        considered dead unless its lease has been renewed (see
+        :py:func:`renew_task_leases`). Pass ``None`` as ``task_id`` to
+        clear the task.
+        """
+        self.task_id = task_id
+        if task_id is None:
+            self.task_expires = None
+        else:
+            self.task_expires = (datetime.datetime.utcnow() +
+                                 datetime.timedelta(seconds=lease))
 
-    def as_dict(self):
-        d = super(ResourceMetadata, self).as_dict()
-        # DomainObject.as_dict doesn't include association proxies
-        d['meta'] = dict(self.meta)
+    @classmethod
+    def release_tasks(cls, instances, task_id):
+        """
+        Clear the extraction task of resources if it has the given ID.
+
+        ``instances`` is an iterable of ``ResourceMetadata`` instances.
+        In contrast to ``set_task(None, None)`` the check and the update
+        are done atomically in the database using a single statement as
+        part of the current transaction, so a newer task that has been
+        registered for a resource in the meantime is kept.
+
+        The updated rows stay locked until the end of the transaction,
+        so the caller should commit right afterwards.
+        """
+        instances = {m.resource_id: m for m in instances}
+        if not instances:
+            return
+        table = resource_metadata_table
+        result = cls.Session.execute(table.update().where(and_(
+            table.c.resource_id.in_(list(instances)),
+            table.c.task_id == task_id)).values(
+            task_id=None, task_expires=None).returning(table.c.resource_id))
+        for (resource_id,) in result:
+            set_committed_value(instances[resource_id], 'task_id', None)
+            set_committed_value(instances[resource_id], 'task_expires', None)
+
+    @classmethod
+    def delete_unless_superseded(cls, instances, task_id=None):
+        """
+        Delete the metadata of resources unless they have a newer task.
+
+        ``instances`` is an iterable of ``ResourceMetadata`` instances.
+        If ``task_id`` is given then only the metadata whose task is
+        either unset or has that ID are deleted. Like
+        :py:meth:`release_tasks` the check and the deletion are done
+        atomically in the database as part of the current transaction.
+
+        Returns the IDs of the resources whose metadata were deleted.
+        The deleted instances are removed from the session.
+        """
+        instances = {m.resource_id: m for m in instances}
+        if not instances:
+            return []
+        table = resource_metadata_table
+        condition = table.c.resource_id.in_(list(instances))
+        if task_id is not None:
+            condition = and_(condition, or_(table.c.task_id == None,
+                                            table.c.task_id == task_id))
+        result = cls.Session.execute(table.delete().where(condition).returning(
+            table.c.resource_id))
+        deleted = [resource_id for (resource_id,) in result]
+        for resource_id in deleted:
+            cls.Session.expunge(instances[resource_id])
+        return deleted
+
+    def is_task_alive(self):
+        """
+        Check if the resource has an extraction task that is not dead.
+
+        Tasks without a lease (which have been registered by older
+        versions) are assumed to be alive.
+        """
+        if not self.task_id:
+            return False
+        if self.task_expires is None:
+            return True
+        return self.task_expires >= datetime.datetime.utcnow()
+
+    def get_download(self):
+        """
+        Get information about the last download of the resource.
+
+        Returns a dict in the format used by
+        :py:func:`ckanext.extractor.lib.download_and_extract`.
+        """
+        return {
+            'url': self.last_url,
+            'hash': self.last_hash,
+            'etag': self.last_etag,
+            'last_modified': self.last_modified,
+        }
+
+    def set_download(self, download):
+        """
+        Store information about the last download of the resource.
+
+        ``download`` is a dict in the format used by
+        :py:func:`ckanext.extractor.lib.download_and_extract`. Passing
+        an empty dict clears the stored information.
+        """
+        self.last_hash = download.get('hash')
+        self.last_etag = download.get('etag')
+        self.last_modified = download.get('last_modified')
+
+    def replace_meta(self, meta):
+        """
+        Replace the stored metadata with new values.
+
+        ``meta`` is a dict containing the new metadata. Only the fields
+        that have actually changed are touched, so that unchanged rows
+        are neither deleted nor re-inserted when the instance is saved.
+        """
+        for key in set(self.meta) - set(meta):
+            del self.meta[key]
+        for key, value in meta.iteritems():
+            if key not in self.meta or self.meta[key] != value:
+                self.meta[key] = value
+
+    @classmethod
+    def get_meta_many(cls, resource_ids, keys=None, truncate=None,
+                      length_only=False):
+        """
+        Load selected metadata of multiple resources from the database.
+
+        Like :py:meth:`get_meta`, but the metadata of all given resources
+        are loaded using a single query.
+
+        Returns a dict that maps the resource IDs to their metadata
+        dicts. Resources without metadata are not included.
+        """
+        resource_ids = list(resource_ids)
+        if not resource_ids or (keys is not None and not keys):
+            return {}
+        if _uses_json_storage():
+            if length_only:
+                value = 'length(e.value)'
+            elif truncate is not None:
+                value = 'substr(e.value, 1, :truncate)'
+            else:
+                value = 'e.value'
+            sql = """
+                SELECT m.resource_id, e.key, {value}
+                FROM {table} AS m, jsonb_each_text(m.meta_json) AS e
+                WHERE m.resource_id = ANY(:resource_ids)
+            """.format(value=value, table=RESOURCE_METADATA_TABLE_NAME)
+            params = {'resource_ids': resource_ids, 'truncate': truncate}
+            if keys is not None:
+                sql += ' AND e.key = ANY(:keys)'
+                params['keys'] = list(keys)
+            rows = cls.Session.execute(text(sql), params)
+        else:
+            value = ResourceMetadatum.value
+            if length_only:
+                value = func.length(value)
+            elif truncate is not None:
+                value = func.substr(value, 1, truncate)
+            rows = cls.Session.query(ResourceMetadatum.resource_id,
+                                     ResourceMetadatum.key, value).filter(
+                ResourceMetadatum.resource_id.in_(resource_ids))
+            if keys is not None:
+                rows = rows.filter(ResourceMetadatum.key.in_(keys))
+        result = {}
+        for resource_id, key, value in rows:
+            result.setdefault(resource_id, {})[key] = value
+        return result
+
+    def get_meta(self, keys=None, truncate=None, length_only=False):
+        """
+        Load selected metadata from the database.
+
+        In contrast to ``meta`` only the requested data is fetched from
+        the database, so that large values (e.g. ``fulltext``) are not
+        loaded unless they are needed.
+
+        ``keys`` is a list of the keys of the metadata that should be
+        loaded. If it is ``None`` then all metadata are loaded.
+
+        If ``truncate`` is given then the values are shortened to at
+        most that many characters. If ``length_only`` is true then the
+        lengths of the values are returned instead of the values.
+
+        Returns a dict.
+        """
+        result = self.get_meta_many([self.resource_id], keys, truncate,
+                                    length_only)
+        return result.get(self.resource_id, {})
+
+    def as_dict(self, keys=None, truncate=None, length_only=False):
+        """
+        Get the metadata and information about their extraction.
+
+        The metadata are contained in the ``meta`` entry. The arguments
+        can be used to restrict the metadata that are loaded from the
+        database, see :py:meth:`get_meta`.
+        """
+        # DomainObject.as_dict would load the (possibly large) JSON
+        # document, so the columns are collected manually.
+        d = {}
+        for column in resource_metadata_table.c:
+            if column.name == 'meta_json':
+                continue
+            value = getattr(self, column.name)
+            if isinstance(value, datetime.date):
+                value = value.isoformat()
+            d[column.name] = value
+        if keys is None and truncate is None and not length_only:
+            d['meta'] = dict(self.meta)
+        else:
+            d['meta'] = self.get_meta(keys, truncate, length_only)
         return d
 
+
+class QueuedJob(BaseObject):
+    """
+    A background job in the database queue.
+
+    See :py:mod:`ckanext.extractor.queue`.
+    """
+    pass
@@ -20,6 +20,7 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import sys
+import time
 
 from sqlalchemy import inspect
 
@@ -42,10 +43,53 @@ def _compress(s, n=50):
         return s[:n/2] + ' ... ' + s[-n/2:]
 
 
+def _format_size(size):
+    return '{:.1f} MB'.format(size / 1024.0 / 1024.0)
+
+
+def _extract_in_process(args):
+    """
+    Extract the metadata of a resource in the current process.
+
+    ``args`` is a tuple ``(ini_path, res_dict, task_id, force)``. The
+    package of the resource is not re-indexed. Returns the result of
+    :py:func:`ckanext.extractor.tasks.extract`, unexpected errors are
+    reported in the same format.
+    """
+    from .tasks import extract
+    ini_path, res_dict, task_id, force = args
+    try:
+        return extract(ini_path, res_dict, task_id, force, index=False)
+    except Exception as e:
+        return {
+            'changed': False,
+            'error': '{}: {}'.format(e.__class__.__name__, e),
+            'size': 0,
+            'res_dict': None,
+        }
+
+
 class ExtractorCommand(CkanCommand):
     """
     Base class for ckanext.extractor Paster commands.
     """
+    def _iter_ids_with_metadata(self):
+        """
+        Iterate over the IDs of all resources which have metadata.
+
+        The IDs are fetched page by page and yielded in sorted order.
+        """
+        from ckan.plugins import toolkit
+        extractor_list = toolkit.get_action('extractor_list')
+        data_dict = {}
+        while True:
+            result = extractor_list({}, data_dict)
+            for id in result['results']:
+                yield id
+            if not result['next_cursor']:
+                return
+            data_dict['cursor'] = result['next_cursor']
+
     def _get_ids(self, only_with_metadata=False):
         """
         Get list of resource IDs from command line arguments.
@@ -61,7 +105,7 @@ class ExtractorCommand(CkanCommand):
                    + 'or "all".')
         if len(self.args) == 1 and self.args[0].lower() == 'all':
             if only_with_metadata:
-                return sorted(toolkit.get_action('extractor_list')({}, {}))
+                return list(self._iter_ids_with_metadata())
             else:
                 from ckan.model import Resource
                 return sorted(r.id for r in Resource.active())
@@ -93,14 +137,29 @@ class ExtractCommand(ExtractorCommand):
     """
     Extract metadata
 
-    extract [--force] (all | ID [ID [...]])
+    extract [--force] [--batch-size N] [--queue NAME]
+            [--sync [--processes N]] (all | ID [ID [...]])
 
     If --force is given then extraction is performed even if the
     the resource hasn't changed or another extraction task for the
     resource is already in progress.
 
+    The resources are extracted in batches, each batch is processed by
+    a single background job. The number of resources per batch can be
+    set using --batch-size (defaults to 100).
+
+    The jobs are added to the low priority queue (see the
+    ckanext.extractor.low_priority_queue setting), so that they don't
+    delay the extraction of resources that are created or updated in
+    the meantime. A different queue can be set using --queue.
+
     Note that a background jobs worker must be running, this command
     only schedules the necessary background tasks.
+
+    If --sync is given then the extraction is performed directly by
+    this command instead, without background jobs. The number of
+    parallel extraction processes can be set using --processes
+    (defaults to 1).
     """
     max_args = None
     min_args = None
@@ -112,18 +171,128 @@ class ExtractCommand(ExtractorCommand):
         self.parser.add_option('--force', default=False,
                                help='Force extraction',
                                action='store_true')
+        self.parser.add_option('--batch-size', default=100, type='int',
+                               help='Number of resources per job')
+        self.parser.add_option('--queue', default=None,
+                               help='Name of the job queue')
+        self.parser.add_option('--sync', default=False,
+                               help='Extract without background jobs',
+                               action='store_true')
+        self.parser.add_option('--processes', default=1, type='int',
+                               help='Number of processes for --sync')
 
     def command(self):
         self._load_config()
         from ckan.plugins import toolkit
-        extract = toolkit.get_action('extractor_extract')
-        for id in self._get_ids():
-            print(id + ': ', end='')
-            result = extract({}, {'id': id, 'force': self.options.force})
-            status = result['status']
-            if result['task_id']:
-                status += ' (task {})'.format(result['task_id'])
-            print(status)
+        if self.options.batch_size < 1:
+            _error('The batch size must be positive.')
+        if self.options.processes < 1:
+            _error('The number of processes must be positive.')
+        if self.options.sync and self.options.queue:
+            _error('--queue cannot be used with --sync.')
+        ids = self._get_ids()
+        if self.options.sync:
+            return self._extract_synchronously(ids)
+        extract_many = toolkit.get_action('extractor_extract_many')
+        batch_size = self.options.batch_size
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            data_dict = {'ids': batch, 'force': self.options.force}
+            if self.options.queue:
+                data_dict['queue'] = self.options.queue
+            results = extract_many({'ignore_auth': True},
+                                   data_dict)['results']
+            for id in batch:
+                try:
+                    result = results[id]
+                except KeyError:
+                    print('{}: not found'.format(id))
+                    continue
+                status = result['status']
+                if result['task_id']:
+                    status += ' (task {})'.format(result['task_id'])
+                print('{}: {}'.format(id, status))
+
+    def _extract_synchronously(self, ids):
+        """
+        Extract resources in local processes instead of background jobs.
+
+        The resources are registered for extraction tasks like for
+        background jobs, so that resources with a running task are
+        skipped (unless ``--force`` is given) and concurrent requests
+        don't extract them a second time. The packages of the extracted
+        resources are re-indexed once all resources have been processed.
+        """
+        import multiprocessing
+        from pylons import config
+        from ckan import model
+        from ckan.plugins import toolkit
+        from .tasks import reindex_packages
+        extract_many = toolkit.get_action('extractor_extract_many')
+        force = self.options.force
+        args = []
+        for start in range(0, len(ids), self.options.batch_size):
+            batch = ids[start:start + self.options.batch_size]
+            # Only register the tasks, the resources are extracted below
+            result = extract_many({'ignore_auth': True, 'enqueue': False},
+                                  {'ids': batch, 'force': force})
+            task_id = result['task_id']
+            for resource_id, res_result in result['results'].iteritems():
+                if task_id and res_result['task_id'] == task_id:
+                    args.append((config['__file__'], {'id': resource_id},
+                                 task_id, force))
+        model.Session.remove()
+
+        counts = {'extracted': 0, 'unchanged': 0, 'failed': 0, 'skipped': 0}
+        size = 0
+        start = time.time()
+        if self.options.processes > 1:
+            # Database connections cannot be shared with the forked
+            # processes, each of them opens its own connections instead
+            model.meta.metadata.bind.dispose()
+            pool = multiprocessing.Pool(self.options.processes)
+            results = pool.imap_unordered(_extract_in_process, args)
+        else:
+            pool = None
+            results = (_extract_in_process(a) for a in args)
+        changed = []
+        try:
+            for i, result in enumerate(results, 1):
+                if result is None:
+                    counts['skipped'] += 1
+                elif result['error']:
+                    counts['failed'] += 1
+                elif result['changed']:
+                    counts['extracted'] += 1
+                else:
+                    counts['unchanged'] += 1
+                if result:
+                    size += result['size']
+                    if result['changed'] and result['res_dict']:
+                        changed.append(result['res_dict'])
+                elapsed = max(time.time() - start, 0.001)
+                sys.stdout.write(
+                    '\r{}/{} resources ({:.1f}/s), {} downloaded ({}/s)'
+                    .format(i, len(args), i / elapsed, _format_size(size),
+                            _format_size(size / elapsed)))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            if pool:
+                pool.terminate()
+            raise
+        else:
+            if pool:
+                pool.close()
+                pool.join()
+        if args:
+            print('')
+        print(('{extracted} extracted, {unchanged} unchanged, {failed} failed, '
+               + '{skipped} skipped').format(**counts))
+        print('{} downloaded in {:.1f}s'.format(_format_size(size),
+              time.time() - start))
+        if changed:
+            print('Re-indexing the datasets of the extracted resources')
+            reindex_packages(changed)
 
 
 class InitCommand(ExtractorCommand):
@@ -152,9 +321,125 @@ class ListCommand(ExtractorCommand):
 
     def command(self):
         self._load_config()
-        from ckan.plugins import toolkit
-        result = toolkit.get_action('extractor_list')({}, {})
-        print('\n'.join(sorted(result)))
+        for id in self._iter_ids_with_metadata():
+            print(id)
+
+
+class MigrateCommand(ExtractorCommand):
+    """
+    Move metadata to another storage
+
+    migrate (json | table)
+
+    Moves the metadata of all resources to the given storage. Use this
+    after changing the ``ckanext.extractor.storage`` setting.
+    """
+    max_args = 1
+    min_args = 1
+    usage = __doc__
+    summary = __doc__.strip().split('\n')[0]
+
+    def command(self):
+        self._load_config()
+        from .model import migrate_storage
+        storage = self.args[0].lower()
+        if storage not in ('json', 'table'):
+            _error('Storage must be either "json" or "table".')
+        migrate_storage(storage)
+
+
+class ReapCommand(ExtractorCommand):
+    """
+    Clear dead extraction tasks
+
+    reap [--all]
+
+    Clears the extraction tasks whose lease has expired. If --all is
+    given then all tasks are cleared, including the ones that are still
+    alive and the ones without a lease.
+
+    The expired claims of jobs in the database queue are released, too,
+    so that these jobs are processed again.
+    """
+    max_args = 0
+    min_args = 0
+    usage = __doc__
+    summary = __doc__.strip().split('\n')[0]
+
+    def __init__(self, name):
+        super(ReapCommand, self).__init__(name)
+        self.parser.add_option('--all', default=False,
+                               help='Clear all tasks',
+                               action='store_true')
+
+    def command(self):
+        self._load_config()
+        from . import model
+        from .queue import release_expired_claims
+        count = model.reap_tasks(expired_only=not self.options.all)
+        print('{} tasks cleared'.format(count))
+        if model.job_table.exists():
+            count = release_expired_claims()
+            model.QueuedJob.Session.commit()
+            print('{} job claims released'.format(count))
+
+
+class ReindexCommand(ExtractorCommand):
+    """
+    Rebuild the search index
+
+    reindex [--batch-size N] [--refresh] [ID [ID [...]]]
+
+    Works like CKAN's ``search-index rebuild`` command, but the extracted
+    metadata of a whole batch of datasets are loaded using a single
+    database query instead of one query per dataset.
+
+    If no dataset IDs are given then the search index is cleared and all
+    datasets are reindexed, which also removes the entries of datasets
+    that have been deleted. If --refresh is given then the index is not
+    cleared beforehand, so that it stays available during the rebuild
+    but stale entries are kept. The number of datasets per batch can be
+    set using --batch-size (defaults to 100).
+    """
+    max_args = None
+    min_args = 0
+    usage = __doc__
+    summary = __doc__.strip().split('\n')[0]
+
+    def __init__(self, name):
+        super(ReindexCommand, self).__init__(name)
+        self.parser.add_option('--batch-size', default=100, type='int',
+                               help='Number of datasets per batch')
+        self.parser.add_option('--refresh', default=False,
+                               help='Do not clear the index beforehand',
+                               action='store_true')
+
+    def command(self):
+        self._load_config()
+        from ckan.lib.search import clear_all, commit, rebuild
+        from ckan.model import Package, Session
+        from .plugin import prefetch_metadata
+        if self.options.batch_size < 1:
+            _error('The batch size must be positive.')
+        if self.args:
+            ids = self.args[:]
+        else:
+            query = Session.query(Package.id).filter(
+                Package.state != 'deleted').order_by(Package.id)
+            ids = [row[0] for row in query]
+            if not self.options.refresh:
+                clear_all()
+        batch_size = self.options.batch_size
+        try:
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                prefetch_metadata(batch)
+                rebuild(package_ids=batch, defer_commit=True)
+                print('{}/{} datasets indexed'.format(
+                      start + len(batch), len(ids)))
+        finally:
+            prefetch_metadata([])
+        commit()
 
 
 class ShowCommand(ExtractorCommand):
@@ -192,3 +477,74 @@ class ShowCommand(ExtractorCommand):
             if i < len(ids) - 1:
                 print('')
 
+
+class WorkerCommand(ExtractorCommand):
+    """
+    Start a background worker for extraction jobs
+
+    worker [--burst] [--no-fork] [QUEUE [QUEUE [...]]]
+    worker --database [--burst] [QUEUE [QUEUE [...]]]
+
+    Works like CKAN's ``jobs worker`` command, but the CKAN environment
+    is loaded only once when the worker starts instead of once per
+    extraction job.
+
+    If --database is given then the worker processes the jobs from the
+    database queue (see the ``ckanext.extractor.queue`` setting) instead
+    of RQ. All jobs are then executed in the worker process itself.
+
+    The worker processes the jobs of the given queues in the given
+    order, so jobs in the first queue take priority. If no queue names
+    are given then the worker listens to the high and the low priority
+    queues (see the ckanext.extractor.high_priority_queue and
+    ckanext.extractor.low_priority_queue settings). If --burst is given
+    then the worker exits as soon as all its queues are empty.
+
+    By default, each job is executed in a separate forked process. If
+    --no-fork is given then all jobs are executed in the worker process
+    itself, so that resources like HTTP connections can be reused
+    between jobs.
+    """
+    max_args = None
+    min_args = 0
+    usage = __doc__
+    summary = __doc__.strip().split('\n')[0]
+
+    def __init__(self, name):
+        super(WorkerCommand, self).__init__(name)
+        self.parser.add_option('--burst', default=False,
+                               help='Exit when all queues are empty',
+                               action='store_true')
+        self.parser.add_option('--no-fork', default=False,
+                               help='Execute jobs in the worker process',
+                               action='store_true')
+        self.parser.add_option('--database', default=False,
+                               help='Process the database queue',
+                               action='store_true')
+
+    def command(self):
+        self._load_config()
+        from pylons import config
+        from .config import load_config
+        # The work horse processes are forked from this process. Loading
+        # the configuration via our own mechanism marks it as loaded so
+        # that the extraction jobs don't reload it.
+        load_config(config['__file__'])
+        from .config import get_queue_names
+        queues = self.args or get_queue_names()
+        if self.options.database:
+            from .queue import work
+            return work(burst=self.options.burst, queues=queues)
+        try:
+            from ckan.lib.jobs import Worker
+        except ImportError:
+            # CKAN 2.6 or older
+            from ckanext.rq.jobs import Worker
+        if self.options.no_fork:
+            from rq import SimpleWorker
+            # CKAN's worker class takes care of the queue names and the
+            # database connections, RQ's SimpleWorker executes the jobs
+            # without forking.
+            Worker = type(str('SimpleWorker'), (Worker, SimpleWorker), {})
+        Worker(queues).work(burst=self.options.burst)
+
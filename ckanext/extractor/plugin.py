@@ -39,6 +39,26 @@ get_action = toolkit.get_action
 # Template for the Solr field names
 SOLR_FIELD = 'ckanext-extractor_{id}_{key}'
 
+# Metadata that have been loaded in advance for packages that are about
+# to be indexed, see ``prefetch_metadata``.
+_prefetched = {}
+
+
+def prefetch_metadata(package_ids):
+    """
+    Load the metadata of multiple packages in advance.
+
+    The metadata of all resources of the given packages are loaded using
+    a single database query and are then used when the packages are
+    indexed. Each package's entry is discarded once it has been indexed.
+
+    Calling this function replaces all previously prefetched metadata,
+    so only the current batch of packages is kept in memory. Pass an
+    empty list to clear the prefetched metadata.
+    """
+    _prefetched.clear()
+    _prefetched.update(model.ResourceMetadata.get_many_by_package(package_ids))
+
 
 def _is_resource(obj):
     """
@@ -106,9 +126,11 @@ class ExtractorPlugin(plugins.SingletonPlugin):
                     except toolkit.ObjectNotFound:
                         pass
             else:
-                for res_dict in obj.get('resources', []):
-                    ctx = dict(context, ignore_auth=True)
-                    get_action('extractor_extract')(ctx, res_dict)
+                ctx = dict(context, ignore_auth=True)
+                get_action('extractor_extract_many')(ctx, {
+                    'package_id': obj['id'],
+                    'priority': 'high',
+                })
 
     #
     # IResourceController
@@ -128,14 +150,19 @@ class ExtractorPlugin(plugins.SingletonPlugin):
 
     def before_index(self, pkg_dict):
         data_dict = json.loads(pkg_dict['data_dict'])
-        for resource in data_dict['resources']:
-            if not is_format_indexed(resource['format']):
-                continue
-            try:
-                metadata = get_action('extractor_show')({}, resource)
-            except NotFound:
+        resources = [r for r in data_dict['resources']
+                     if is_format_indexed(r['format'])]
+        all_meta = _prefetched.pop(data_dict['id'], None)
+        if all_meta is None:
+            # Load the metadata of all resources using a single query
+            all_metadata = model.ResourceMetadata.get_many(
+                r['id'] for r in resources)
+            all_meta = {id: m.meta for id, m in all_metadata.iteritems()}
+        for resource in resources:
+            meta = all_meta.get(resource['id'])
+            if meta is None:
                 continue
-            for key, value in metadata['meta'].iteritems():
+            for key, value in meta.iteritems():
                 if is_field_indexed(key):
                     field = SOLR_FIELD.format(id=resource['id'], key=key)
                     pkg_dict[field] = value
@@ -149,8 +176,10 @@ class ExtractorPlugin(plugins.SingletonPlugin):
         return {
             'extractor_delete': action.extractor_delete,
             'extractor_extract': action.extractor_extract,
+            'extractor_extract_many': action.extractor_extract_many,
             'extractor_list': action.extractor_list,
             'extractor_show': action.extractor_show,
+            'extractor_show_many': action.extractor_show_many,
         }
 
     #
@@ -161,7 +190,9 @@ class ExtractorPlugin(plugins.SingletonPlugin):
         return {
             'extractor_delete': auth.extractor_delete,
             'extractor_extract': auth.extractor_extract,
+            'extractor_extract_many': auth.extractor_extract_many,
             'extractor_list': auth.extractor_list,
             'extractor_show': auth.extractor_show,
+            'extractor_show_many': auth.extractor_show_many,
         }
 
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016-2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Database job queue.
+
+An alternative to RQ that stores the background jobs in a table next
+to the metadata tables. This is used if ``ckanext.extractor.queue`` is
+set to ``database``.
+
+Workers claim jobs using ``SELECT ... FOR UPDATE SKIP LOCKED``, so any
+number of worker processes (even on different machines) can process
+the queue concurrently without processing a job twice.
+
+Claims have a lease (see ``ckanext.extractor.task_lease``) that is
+renewed while the job is running. If a worker dies then its claim
+expires and the job is processed again by another worker.
+
+Like in RQ, each job belongs to a named queue. Workers process the jobs
+of the queues they listen to in the order in which the queues are
+given, so that jobs in the first queue take priority.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import importlib
+import json
+import logging
+import os
+import socket
+import time
+
+from sqlalchemy import text
+
+from ckan.model.types import make_uuid
+from ckan.model.meta import metadata
+
+from .config import get as get_config, get_queue_names
+from .lib import Heartbeat
+from .model import JOB_TABLE_NAME, QueuedJob
+
+
+log = logging.getLogger(__name__)
+
+# Number of seconds a worker waits before polling an empty queue again
+POLL_INTERVAL = 2
+
+# The job that is currently run by this process, see ``get_current_job``
+_current_job = None
+
+
+def enqueue(fn, args=None, title=None, queue_name=None, job_id=None):
+    """
+    Add a job to the queue.
+
+    ``fn`` is a module-level function and ``args`` is a list of its
+    JSON-serializable positional arguments. ``queue_name`` is the name
+    of the queue to which the job is added (defaults to the high
+    priority queue, see ``ckanext.extractor.high_priority_queue``).
+    ``job_id`` is the ID of the job, a random ID is used by default.
+
+    The job is added to the current database transaction, so it only
+    becomes visible to the workers once the caller commits. This allows
+    the registration of a job to be committed together with the job.
+
+    Returns the ``QueuedJob`` instance.
+    """
+    job = QueuedJob(function='{}.{}'.format(fn.__module__, fn.__name__),
+                    args=list(args or []), title=title,
+                    queue=queue_name or get_config('high_priority_queue'))
+    if job_id is not None:
+        job.id = job_id
+    QueuedJob.Session.add(job)
+    QueuedJob.Session.flush()
+    return job
+
+
+def enqueue_unique(fn, args, unique_key, title=None, queue_name=None):
+    """
+    Add a job to the queue unless an equivalent job is already waiting.
+
+    Works like :py:func:`enqueue`, but at most one unclaimed job with
+    the given ``unique_key`` can exist. Once that job has been claimed
+    by a worker, a new one can be added.
+
+    Returns the ID of the new job or ``None`` if an unclaimed job with
+    the same key exists.
+    """
+    sql = text("""
+        INSERT INTO {table} (id, created, function, args, title, queue,
+                             unique_key)
+        VALUES (:id, now() at time zone 'utc', :function,
+                CAST(:args AS jsonb), :title, :queue, :unique_key)
+        ON CONFLICT (unique_key) WHERE claimed IS NULL
+            AND unique_key IS NOT NULL DO NOTHING
+        RETURNING id
+    """.format(table=JOB_TABLE_NAME))
+    params = {
+        'id': make_uuid(),
+        'function': '{}.{}'.format(fn.__module__, fn.__name__),
+        'args': json.dumps(list(args or [])),
+        'title': title,
+        'queue': queue_name or get_config('high_priority_queue'),
+        'unique_key': unique_key,
+    }
+    row = QueuedJob.Session.execute(sql, params).first()
+    return row[0] if row is not None else None
+
+
+def get_current_job():
+    """
+    Get the job that is currently run by this process.
+
+    Returns a ``QueuedJob`` instance or ``None`` if this function is not
+    called from within a job of the database queue.
+    """
+    return _current_job
+
+
+def cancel(job_id):
+    """
+    Remove a job from the queue unless it has already been claimed.
+
+    Like :py:func:`enqueue` this only affects the current database
+    transaction, the caller has to commit.
+
+    Returns ``True`` if the job was removed and ``False`` otherwise.
+    """
+    count = QueuedJob.Session.query(QueuedJob).filter_by(
+        id=job_id, claimed=None).delete(synchronize_session=False)
+    return count > 0
+
+
+def claim(worker, queues=None):
+    """
+    Claim the next unclaimed job.
+
+    ``worker`` is a string that identifies the claiming worker. Jobs
+    that are locked by a concurrent claim are skipped.
+
+    ``queues`` is a list of queue names in the order of their priority
+    (defaults to the configured high and low priority queues). The
+    oldest job from the first queue that is not empty is claimed. The
+    queues are checked one after another, so that each check can use
+    the index on the unclaimed jobs of a queue.
+
+    Jobs whose claims have expired are released first, so that they can
+    be claimed again (see :py:func:`release_expired_claims`).
+
+    Returns the claimed ``QueuedJob`` instance or ``None`` if the queue
+    is empty.
+    """
+    release_expired_claims()
+    sql = text("""
+        UPDATE {table} SET claimed = now() at time zone 'utc', worker = :worker,
+            claim_expires = now() at time zone 'utc'
+                            + :lease * interval '1 second'
+        WHERE id = (
+            SELECT id FROM {table}
+            WHERE claimed IS NULL AND queue = :queue
+            ORDER BY created LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id
+    """.format(table=JOB_TABLE_NAME))
+    params = {'worker': worker, 'lease': get_config('task_lease')}
+    row = None
+    for queue_name in queues or get_queue_names():
+        row = QueuedJob.Session.execute(sql, dict(params, queue=queue_name)
+                                        ).first()
+        if row is not None:
+            break
+    QueuedJob.Session.commit()
+    if row is None:
+        return None
+    return QueuedJob.Session.query(QueuedJob).get(row[0])
+
+
+def release_expired_claims():
+    """
+    Release the claims of jobs whose workers have died.
+
+    Claims whose lease has expired are removed, so that the jobs can be
+    claimed again. Like :py:func:`enqueue` this only affects the current
+    database transaction, the caller has to commit.
+
+    Returns the number of released claims.
+    """
+    sql = text("""
+        UPDATE {table} SET claimed = NULL, claim_expires = NULL, worker = NULL
+        WHERE claimed IS NOT NULL AND (claim_expires IS NULL
+            OR claim_expires < now() at time zone 'utc')
+        RETURNING id, worker
+    """.format(table=JOB_TABLE_NAME))
+    rows = QueuedJob.Session.execute(sql).fetchall()
+    for job_id, worker in rows:
+        log.warn('Released expired claim of worker {} for job {}'.format(
+                 worker, job_id))
+    return len(rows)
+
+
+def _renew_claim(job_id, lease):
+    """
+    Renew the lease of a job's claim.
+
+    The update is executed and committed using a separate database
+    connection, so this function can be called from another thread.
+    """
+    metadata.bind.execute(text("""
+        UPDATE {table} SET claim_expires = now() at time zone 'utc'
+                                           + :lease * interval '1 second'
+        WHERE id = :id
+    """.format(table=JOB_TABLE_NAME)), id=job_id, lease=lease)
+
+
+def run(job):
+    """
+    Execute a job and remove it from the queue.
+
+    The job's claim is renewed regularly while it is running. Errors are
+    logged. The job is removed from the queue even if it failed,
+    extraction errors are recorded in the resource's metadata.
+    """
+    job_id = job.id
+    module_name, function_name = job.function.rsplit('.', 1)
+    log.info('Starting job {} ("{}")'.format(job_id, job.title))
+    start = time.time()
+    lease = get_config('task_lease')
+    global _current_job
+    _current_job = job
+    try:
+        fn = getattr(importlib.import_module(module_name), function_name)
+        with Heartbeat(lambda: _renew_claim(job_id, lease),
+                       max(lease / 3.0, 1)):
+            fn(*job.args)
+        log.info('Job {} finished in {:.3f}s'.format(job_id,
+                 time.time() - start))
+    except Exception:
+        log.exception('Job {} failed'.format(job_id))
+    finally:
+        _current_job = None
+        # Discard anything the job has left in the session
+        QueuedJob.Session.rollback()
+        QueuedJob.Session.query(QueuedJob).filter_by(id=job_id).delete()
+        QueuedJob.Session.commit()
+
+
+def work(burst=False, queues=None):
+    """
+    Process jobs from the queue.
+
+    ``queues`` is a list of the names of the queues to process, see
+    :py:func:`claim`.
+
+    If ``burst`` is true then this function returns once the queues are
+    empty. Otherwise it waits for new jobs forever.
+    """
+    queues = queues or get_queue_names()
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    log.info('Worker {} started, listening to {}'.format(worker,
+             ', '.join(queues)))
+    while True:
+        job = claim(worker, queues)
+        if job is not None:
+            run(job)
+        elif burst:
+            log.info('Queue is empty, worker {} exits'.format(worker))
+            return
+        else:
+            time.sleep(POLL_INTERVAL)
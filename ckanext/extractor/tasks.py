@@ -19,64 +19,445 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import collections
 import datetime
 import logging
 import tempfile
 
 from sqlalchemy.orm.exc import NoResultFound
 from requests.exceptions import RequestException
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 
 from ckan.lib import search
+from ckan.model import Resource
 from ckan.plugins import PluginImplementations, toolkit
 
-from .config import is_field_indexed, load_config
-from .model import ResourceMetadata, ResourceMetadatum
-from .lib import download_and_extract
+from .config import (get as get_config, is_field_indexed, is_format_indexed,
+                     load_config)
+from .model import (add_pending_reindex, get_pending_reindex,
+                    remove_pending_reindex, renew_task_leases,
+                    ResourceMetadata, ResourceMetadatum)
+from .lib import (download_and_extract, ExtractionError, Heartbeat,
+                  ResourceUnchanged)
 from .interfaces import IExtractorPostprocessor
+from . import queue
+
+try:
+    from ckan.lib.jobs import get_queue as _get_rq_queue
+except ImportError:
+    # CKAN 2.6 or older
+    from ckanext.rq.jobs import get_queue as _get_rq_queue
 
 
 log = logging.getLogger(__name__)
 
+# Redis key for the set of IDs of a package's resources whose extracted
+# metadata is waiting to be indexed
+PENDING_REINDEX_KEY = 'ckanext-extractor:pending-reindex:{package_id}'
+
+# Redis key for the ID of the latest ``reindex`` job of a package
+REINDEX_JOB_KEY = 'ckanext-extractor:reindex-job:{package_id}'
+
+# Number of resources whose metadata are committed to the database in a
+# single transaction by ``extract_many``
+COMMIT_INTERVAL = 20
+
+# Number of seconds that are added to ``ckanext.extractor.job_timeout``
+# for each resource of an extraction job to cover the overhead of
+# loading and storing the data
+JOB_TIMEOUT_MARGIN = 30
+
 
-def extract(ini_path, res_dict):
+def get_job_timeout(num_resources):
+    """
+    Get the timeout for a job that extracts the given number of resources.
+
+    The download and extraction of each resource is limited by
+    ``ckanext.extractor.job_timeout``, so the job's timeout is scaled
+    by the number of resources. This makes sure that RQ doesn't kill a
+    batch job while it is still working.
+    """
+    return int(num_resources * (get_config('job_timeout') +
+                                JOB_TIMEOUT_MARGIN))
+
+
+def enqueue_job(fn, args, title=None, queue_name=None, timeout=None,
+                job_id=None):
+    """
+    Enqueue a background job.
+
+    Depending on the ``ckanext.extractor.queue`` setting the job is
+    added to RQ or to the database queue (see
+    :py:mod:`ckanext.extractor.queue`). Jobs in the database queue are
+    only committed together with the current database transaction.
+
+    ``queue_name`` is the name of the queue to which the job is added.
+    It defaults to the high priority queue (see the
+    ``ckanext.extractor.high_priority_queue`` setting).
+
+    ``timeout`` is the number of seconds after which RQ kills the job
+    (see :py:func:`get_job_timeout`). If it is not given then RQ's
+    default timeout is used. Jobs in the database queue are not killed.
+
+    ``job_id`` is the ID of the job. A random ID is used if it is not
+    given.
+
+    Returns the job. Its ``id`` attribute contains the job's ID.
+    """
+    queue_name = queue_name or get_config('high_priority_queue')
+    if get_config('queue') == 'database':
+        return queue.enqueue(fn, args, title=title, queue_name=queue_name,
+                             job_id=job_id)
+    # Works like CKAN's ``enqueue_job``, which doesn't support timeouts
+    # and job IDs
+    job = _get_rq_queue(queue_name).enqueue_call(func=fn, args=args,
+                                                 timeout=timeout,
+                                                 job_id=job_id)
+    job.meta['title'] = title
+    job.save()
+    log.info('Added background job {} ("{}") to queue "{}"'.format(
+             job.id, title, queue_name))
+    return job
+
+
+def cancel_job(job_id):
+    """
+    Cancel a queued background job that is no longer needed.
+
+    Jobs that have not been started by a worker yet are removed from
+    their queue. Jobs that are already running are not affected, they
+    skip all resources that have been registered for a newer task in
+    the meantime (see :py:func:`extract`).
+    """
+    if get_config('queue') == 'database':
+        queue.cancel(job_id)
+        return
+    connection = _get_rq_queue().connection
+    try:
+        job = Job.fetch(job_id, connection=connection)
+    except NoSuchJobError:
+        return
+    if job.is_queued:
+        job.cancel()
+
+
+def extract(ini_path, res_dict, task_id=None, force=False, index=True):
     """
     Download resource, extract and store metadata.
 
     The extracted metadata is stored in the database.
 
-    Note that this task does check whether the resource exists in the
-    database, whether the resource's format is indexed or whether there
-    is an existing task working on the resource's metadata. This is the
-    responsibility of the caller.
+    Only the ID of the given resource dict is used: the resource is
+    re-read when the task starts, so that changes made after the task
+    was scheduled are picked up.
+
+    ``task_id`` is the ID under which the task has been registered in
+    the resource's metadata. If the resource has been registered for
+    another extraction task in the meantime (for example by a forced
+    extraction) then this task has been superseded and the resource is
+    skipped. If ``task_id`` is not given then the resource is always
+    extracted.
+
+    If the resource's format is not indexed anymore (for example because
+    it has been changed after the task was scheduled) then the resource
+    is skipped and its metadata are deleted.
 
     The task does check which metadata fields are configured to be
     indexed and only stores those in the database.
 
-    Any previously stored metadata for the resource is cleared.
+    Any previously stored metadata for the resource is replaced. Only
+    fields whose values have changed are updated in the database. If
+    the downloaded file is identical to the one from the previous
+    extraction then the extraction, the update of the stored metadata
+    and the re-indexing are skipped.
+
+    If ``force`` is true then the file is always downloaded completely
+    and extracted, even if it has not changed. This is used when the
+    extraction settings have changed.
+
+    If ``index`` is false then the resource's package is not re-indexed.
+    The caller is then responsible for re-indexing it, for example
+    using :py:func:`reindex_packages`.
+
+    If the download or the extraction fails then the error is stored in
+    the ``last_error`` attribute of the resource's metadata.
+
+    Returns a dict with the following entries, or ``None`` if the
+    resource was skipped because it does not exist anymore, because its
+    package is private, because its format is not indexed or because the
+    task has been superseded:
+
+    :changed: Whether the resource's file has changed since the last
+        extraction
+    :error: The error message if the download or extraction failed (or
+        ``None``)
+    :size: The number of bytes that have been downloaded
+    :res_dict: The current resource dict
     """
     load_config(ini_path)
 
-    # Get package data before doing any hard work so that we can fail
-    # early if the package is private.
-    try:
-        toolkit.get_action('package_show')({'validate': False},
-                                           {'id': res_dict['package_id']})
-    except toolkit.NotAuthorized:
-        log.debug(('Not extracting resource {} since it belongs to the ' +
-                  'private dataset {}.').format(res_dict['id'],
-                  res_dict['package_id']))
+    # Get the current resource data before doing any hard work. This
+    # also makes us fail early if the package is private.
+    res_dicts = _get_public_res_dicts([res_dict['id']])
+    if not res_dicts:
         return
+    res_dict = res_dicts[0]
 
     try:
         metadata = ResourceMetadata.one(resource_id=res_dict['id'])
     except NoResultFound:
-        metadata = ResourceMetadata.create(resource_id=res_dict['id'])
+        metadata = None
+    if not is_format_indexed(res_dict['format']):
+        if _drop_ignored([metadata] if metadata else [], task_id) and index:
+            _schedule_reindex(ini_path, res_dict)
+        return
+    if metadata is None:
+        metadata = _create_missing_metadata([res_dict['id']])[res_dict['id']]
+    if _is_superseded(metadata, task_id):
+        return
     try:
+        with _LeaseRenewal([res_dict['id']], task_id):
+            changed, download = _extract(res_dict, metadata, force)
+    finally:
+        _release_tasks([metadata], task_id)
+        metadata.save()
+    result = {
+        'changed': changed,
+        'error': metadata.last_error,
+        'size': download.get('size', 0),
+        'res_dict': res_dict,
+    }
+    if not changed:
+        return result
+
+    for plugin in PluginImplementations(IExtractorPostprocessor):
+        plugin.extractor_after_save(res_dict, metadata.as_dict())
+
+    if index:
+        _schedule_reindex(ini_path, res_dict)
+    return result
+
+
+def extract_many(ini_path, resource_ids, task_id=None, force=False):
+    """
+    Download resources, extract and store their metadata.
+
+    Works like :py:func:`extract` for each of the resources, but all of
+    them are processed in a single job so that the per-job overhead is
+    only paid once. Only the resource IDs are passed to the job, the
+    resource data is loaded once per package and group of resources
+    right before the group is processed. ``task_id`` and ``force`` work
+    like for :py:func:`extract`.
+
+    The metadata are committed to the database in groups of
+    ``COMMIT_INTERVAL`` resources and each affected package is
+    re-indexed only once at the end of the job.
+
+    Unexpected errors are recorded in the metadata of the affected
+    resource and logged. In contrast to :py:func:`extract` they don't
+    abort the job, the remaining resources are still processed.
+    """
+    load_config(ini_path)
+    resource_ids = list(resource_ids)
+    changed = collections.OrderedDict()
+    for start in range(0, len(resource_ids), COMMIT_INTERVAL):
+        batch = _get_public_res_dicts(
+            resource_ids[start:start + COMMIT_INTERVAL])
+        all_metadata = ResourceMetadata.get_many(r['id'] for r in batch)
+        # Formats may have been changed since the task was scheduled
+        ignored = {r['id']: r for r in batch
+                   if not is_format_indexed(r['format'])}
+        batch = [r for r in batch if r['id'] not in ignored]
+        dropped = _drop_ignored([m for id, m in all_metadata.iteritems()
+                                 if id in ignored], task_id)
+        for resource_id in dropped:
+            changed.setdefault(ignored[resource_id]['package_id'], [])
+        all_metadata.update(_create_missing_metadata(
+            r['id'] for r in batch if r['id'] not in all_metadata))
+        processed = []
+        saved = []
+        with _LeaseRenewal(resource_ids[start:], task_id):
+            for res_dict in batch:
+                metadata = all_metadata[res_dict['id']]
+                if _is_superseded(metadata, task_id):
+                    continue
+                processed.append(metadata)
+                try:
+                    if _extract(res_dict, metadata, force)[0]:
+                        saved.append((res_dict, metadata))
+                except Exception:
+                    log.exception('Failed to extract metadata from '
+                                  'resource {}'.format(res_dict['id']))
+        # The lease renewal must have stopped before the tasks are
+        # released, since it would block on the locked rows otherwise
+        _release_tasks(processed, task_id)
+        ResourceMetadata.Session.commit()
+        for res_dict, metadata in saved:
+            for plugin in PluginImplementations(IExtractorPostprocessor):
+                plugin.extractor_after_save(res_dict, metadata.as_dict())
+            changed.setdefault(res_dict['package_id'], []).append(res_dict)
+    for package_id, package_res_dicts in changed.iteritems():
+        _reindex(package_id, package_res_dicts)
+
+
+def reindex_packages(res_dicts):
+    """
+    Re-index the packages of resources whose metadata have been extracted.
+
+    ``res_dicts`` is an iterable of resource dicts. Each package is
+    re-indexed only once, see :py:func:`extract`.
+    """
+    changed = collections.OrderedDict()
+    for res_dict in res_dicts:
+        changed.setdefault(res_dict['package_id'], []).append(res_dict)
+    for package_id, package_res_dicts in changed.iteritems():
+        _reindex(package_id, package_res_dicts)
+
+
+def _is_superseded(metadata, task_id):
+    """
+    Check if a resource has been registered for a newer task.
+
+    ``metadata`` is the resource's ``ResourceMetadata`` instance and
+    ``task_id`` is the ID of the current task (or ``None``).
+    """
+    if task_id is None or metadata.task_id in (None, task_id):
+        return False
+    log.debug('Skipping resource {} since task {} has been superseded by '
+              'task {}.'.format(metadata.resource_id, task_id,
+              metadata.task_id))
+    return True
+
+
+class _LeaseRenewal(Heartbeat):
+    """
+    Context manager for renewing the task leases of resources.
+
+    The leases are renewed when the context is entered and then
+    regularly by a background thread until the context is left, so that
+    they are kept alive even while the main thread is blocked by a
+    download or an extraction. If ``task_id`` is given then only the
+    leases of that task are renewed.
+    """
+    def __init__(self, resource_ids, task_id=None):
+        resource_ids = list(resource_ids)
+        lease = get_config('task_lease')
+        super(_LeaseRenewal, self).__init__(
+            lambda: renew_task_leases(resource_ids, lease, task_id),
+            max(lease / 3.0, 1))
+
+
+def _create_missing_metadata(resource_ids):
+    """
+    Create the metadata of resources that don't have any yet.
+
+    The metadata are created using ``ResourceMetadata.lock_many``, so
+    metadata that are created concurrently by another transaction are
+    used instead of failing. The creation is committed right away, so
+    that the rows are not locked during the extraction.
+
+    Returns a dict that maps the resource IDs to their
+    ``ResourceMetadata`` instances.
+    """
+    resource_ids = list(resource_ids)
+    if not resource_ids:
+        return {}
+    all_metadata = ResourceMetadata.lock_many(resource_ids)[0]
+    ResourceMetadata.Session.commit()
+    return all_metadata
+
+
+def _drop_ignored(all_metadata, task_id):
+    """
+    Delete the metadata of resources whose format is not indexed.
+
+    ``all_metadata`` is a list of ``ResourceMetadata`` instances.
+    Metadata that have been registered for a newer task are kept, the
+    newer task takes care of them. The deletion is committed.
+
+    Returns the IDs of the resources whose metadata were deleted.
+    """
+    deleted = ResourceMetadata.delete_unless_superseded(all_metadata, task_id)
+    ResourceMetadata.Session.commit()
+    for resource_id in deleted:
+        log.debug('Deleted metadata of resource {} since its format is not '
+                  'indexed.'.format(resource_id))
+    return deleted
+
+
+def _release_tasks(all_metadata, task_id):
+    """
+    Clear the extraction tasks of processed resources.
+
+    ``all_metadata`` is a list of ``ResourceMetadata`` instances. If
+    ``task_id`` is given then only the tasks with that ID are cleared
+    (see ``ResourceMetadata.release_tasks``). Otherwise the tasks are
+    cleared unconditionally.
+
+    The affected rows are locked until the next commit, so this must
+    only be called after the renewal of their leases has stopped.
+    """
+    if task_id is None:
+        for metadata in all_metadata:
+            metadata.set_task(None, None)
+    else:
+        ResourceMetadata.release_tasks(all_metadata, task_id)
+
+
+def _get_public_res_dicts(resource_ids):
+    """
+    Get the dicts of resources that belong to public packages.
+
+    Each package is only loaded once. Resources that don't exist or
+    that belong to private packages are skipped.
+    """
+    resource_ids = set(resource_ids)
+    query = Resource.Session.query(Resource.package_id).filter(
+        Resource.id.in_(resource_ids)).distinct()
+    res_dicts = []
+    for (package_id,) in query:
+        try:
+            pkg_dict = toolkit.get_action('package_show')(
+                {'validate': False}, {'id': package_id})
+        except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
+            log.debug(('Not extracting resources of dataset {} since it is '
+                      + 'private or does not exist.').format(package_id))
+            continue
+        res_dicts.extend(res_dict for res_dict in pkg_dict['resources']
+                         if res_dict['id'] in resource_ids)
+    return res_dicts
+
+
+def _extract(res_dict, metadata, force=False):
+    """
+    Download a resource, extract its metadata and update them.
+
+    ``metadata`` is the resource's ``ResourceMetadata`` instance. It is
+    updated but not saved, that is the responsibility of the caller.
+    The resource's task is not cleared, see ``_release_tasks``.
+
+    If ``force`` is true then the previous download is ignored, so that
+    neither a conditional request is made nor the file's hash is
+    compared.
+
+    Returns a tuple ``(changed, download)``. ``changed`` is ``False``
+    if the resource's file has not changed since the last extraction and
+    ``True`` otherwise. ``download`` is the download information as
+    returned by :py:func:`ckanext.extractor.lib.download_and_extract`.
+    """
+    meta = {}
+    download = {}
+    unchanged = False
+    error = None
+    try:
+        previous = None if force else metadata.get_download()
         metadata.last_url = res_dict['url']
         metadata.last_format = res_dict['format']
         metadata.last_extracted = datetime.datetime.now()
-        metadata.meta.clear()
-        extracted = download_and_extract(res_dict['url'])
+        extracted, new_download = download_and_extract(res_dict['url'],
+                                                       previous)
         for plugin in PluginImplementations(IExtractorPostprocessor):
             plugin.extractor_after_extract(res_dict, extracted)
         for key, value in extracted.iteritems():
@@ -92,23 +473,151 @@ def extract(ini_path, res_dict):
                           res_dict['id']))
                 value = ', '.join(value)
 
-            metadata.meta[key] = value
+            meta[key] = value
+        download = new_download
+    except ResourceUnchanged as e:
+        unchanged = True
+        download = e.download
     except RequestException as e:
         log.warn('Failed to download resource data from "{}": {}'.format(
                  res_dict['url'], e.message))
+        error = 'Download failed: {}'.format(e.message)
+    except ExtractionError as e:
+        error = '{}'.format(e)
+        log.warn('Failed to extract metadata from resource {}: {}'.format(
+                 res_dict['id'], error))
+    except Exception as e:
+        # Record unexpected errors, too, but still let the job fail
+        error = '{}: {}'.format(e.__class__.__name__, e)
+        raise
     finally:
-        metadata.task_id = None
-        metadata.save()
+        if not unchanged:
+            metadata.replace_meta(meta)
+        metadata.set_download(download)
+        metadata.last_error = error
 
-    for plugin in PluginImplementations(IExtractorPostprocessor):
-        plugin.extractor_after_save(res_dict, metadata.as_dict())
+    if unchanged:
+        log.debug('Not updating metadata of resource {} since its file has '
+                  .format(res_dict['id']) + 'not changed.')
+        return False, download
+    return True, download
+
+
+def reindex(ini_path, package_id):
+    """
+    Re-index a package after the extraction of some of its resources.
+
+    The resources whose metadata is waiting to be indexed are taken from
+    the package's set of pending resources (see ``_schedule_reindex``).
+    If that set is empty then another job has already taken care of the
+    package and nothing is done.
+
+    The resources are only removed from the set once the package has
+    been re-indexed, so they are not lost if the job fails. Resources
+    that are added while the job is running are kept for the next job.
+    """
+    load_config(ini_path)
+    if get_config('queue') == 'database':
+        resource_ids = get_pending_reindex(package_id)
+    else:
+        key = PENDING_REINDEX_KEY.format(package_id=package_id)
+        resource_ids = get_current_job().connection.smembers(key)
+    if not resource_ids:
+        return
+    try:
+        pkg_dict = toolkit.get_action('package_show')({'validate': False},
+                                                      {'id': package_id})
+    except toolkit.ObjectNotFound:
+        log.debug('Not re-indexing package {} since it does not exist '
+                  .format(package_id) + 'anymore.')
+    except toolkit.NotAuthorized:
+        log.debug('Not re-indexing package {} since it is private.'.format(
+                  package_id))
+    else:
+        res_dicts = [res_dict for res_dict in pkg_dict['resources']
+                     if res_dict['id'] in resource_ids]
+        _reindex(package_id, res_dicts)
+    if get_config('queue') == 'database':
+        remove_pending_reindex(package_id, resource_ids)
+        ResourceMetadata.Session.commit()
+    else:
+        get_current_job().connection.srem(key, *resource_ids)
+
+
+def _schedule_reindex(ini_path, res_dict):
+    """
+    Schedule the re-indexing of a resource's package.
+
+    When called from within a background job the package is not
+    re-indexed directly. Instead, the resource is added to the package's
+    set of pending resources and a separate ``reindex`` job is enqueued
+    unless one for the package is still waiting in the queue. A burst of
+    extractions for the resources of a single package therefore results
+    in a single update of the search index. Since a new job is enqueued
+    as soon as the previous one has started, resources are not left
+    behind if a job is lost or fails.
 
+    For the database queue the set is stored in the database and the
+    ``reindex`` job is only enqueued if no such job for the package is
+    waiting already.
+
+    Outside of a background job the package is re-indexed immediately.
+    """
+    package_id = res_dict['package_id']
+    title = 'Search index update for package {}'.format(package_id)
+    if get_config('queue') == 'database':
+        if queue.get_current_job() is None:
+            _reindex(package_id, [res_dict])
+            return
+        add_pending_reindex(package_id, res_dict['id'])
+        queue.enqueue_unique(reindex, (ini_path, package_id),
+                             'reindex:{}'.format(package_id), title=title)
+        ResourceMetadata.Session.commit()
+        return
+    job = get_current_job()
+    if job is None:
+        _reindex(package_id, [res_dict])
+        return
+    connection = job.connection
+    connection.sadd(PENDING_REINDEX_KEY.format(package_id=package_id),
+                    res_dict['id'])
+    job_key = REINDEX_JOB_KEY.format(package_id=package_id)
+    job_id = connection.get(job_key)
+    if job_id is not None and _is_job_queued(job_id, connection):
+        return
+    reindex_job = enqueue_job(reindex, (ini_path, package_id), title=title)
+    connection.set(job_key, reindex_job.id,
+                   ex=get_config('queued_task_lease'))
+
+
+def _is_job_queued(job_id, connection):
+    """
+    Check if an RQ job is still waiting in its queue.
+    """
+    try:
+        return Job.fetch(job_id, connection=connection).is_queued
+    except NoSuchJobError:
+        return False
+
+def _reindex(package_id, res_dicts):
+    """
+    Re-index a package and call the corresponding postprocessing hooks.
+
+    ``res_dicts`` is a list of the dicts of the package's resources
+    whose metadata has been extracted.
+    """
     # We need to update the search index for the package here. Note that
     # we cannot rely on the automatic update that happens when a resource
     # is changed, since our extraction task runs asynchronously and may
     # be finished only when the automatic index update has already run.
-    search.rebuild(package_id=res_dict['package_id'])
+    search.rebuild(package_id=package_id)
 
-    for plugin in PluginImplementations(IExtractorPostprocessor):
-        plugin.extractor_after_index(res_dict, metadata.as_dict())
+    for res_dict in res_dicts:
+        try:
+            metadata = ResourceMetadata.one(resource_id=res_dict['id'])
+        except NoResultFound:
+            # Metadata has been deleted in the meantime
+            continue
+        for plugin in PluginImplementations(IExtractorPostprocessor):
+            plugin.extractor_after_index(res_dict, metadata.as_dict())
 
@@ -19,6 +19,7 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import threading
 import uuid
 
 import mock
@@ -26,7 +27,7 @@ from nose.tools import assert_false, assert_raises, assert_true
 
 from ckan.logic import NotFound
 from ckan.model import Resource
-from ckan.tests.helpers import call_action, FunctionalTestBase
+from ckan.tests.helpers import call_action, change_config, FunctionalTestBase
 from ckan.tests import factories
 
 from ...model import ResourceMetadata
@@ -46,14 +47,16 @@ class TestExtractorList(FunctionalTestBase):
         """
         extractor_list when no metadata exist.
         """
-        assert_equal(call_action('extractor_list'), [])
+        assert_equal(call_action('extractor_list'),
+                     {'count': 0, 'results': [], 'next_cursor': None})
 
     def test_extractor_list_inprogress(self):
         """
         extractor_list does not list metadata that is in progress.
         """
         factories.Resource(format='pdf')
-        assert_equal(call_action('extractor_list'), [])
+        assert_equal(call_action('extractor_list'),
+                     {'count': 0, 'results': [], 'next_cursor': None})
 
     def test_extractor_list_some(self):
         """
@@ -61,7 +64,41 @@ class TestExtractorList(FunctionalTestBase):
         """
         res_dict = factories.Resource(format='pdf')
         fake_process(res_dict)
-        assert_equal(call_action('extractor_list'), [res_dict['id']])
+        assert_equal(call_action('extractor_list'),
+                     {'count': 1, 'results': [res_dict['id']],
+                      'next_cursor': None})
+
+    def test_extractor_list_pagination(self):
+        """
+        extractor_list returns sorted pages linked via cursors.
+        """
+        ids = []
+        for _ in range(3):
+            res_dict = factories.Resource(format='pdf')
+            fake_process(res_dict)
+            ids.append(res_dict['id'])
+        ids.sort()
+        result = call_action('extractor_list', limit=2)
+        assert_equal(result, {'count': 3, 'results': ids[:2],
+                              'next_cursor': ids[1]})
+        result = call_action('extractor_list', limit=2,
+                             cursor=result['next_cursor'])
+        assert_equal(result, {'count': 3, 'results': ids[2:],
+                              'next_cursor': None})
+
+    def test_extractor_list_invalid_limit(self):
+        """
+        extractor_list with an invalid limit.
+        """
+        assert_validation_fails('extractor_list',
+                                'extractor_list accepted a negative limit.',
+                                limit=-1)
+        assert_validation_fails('extractor_list',
+                                'extractor_list accepted a zero limit.',
+                                limit=0)
+        assert_validation_fails('extractor_list',
+                                'extractor_list accepted a too large limit.',
+                                limit=1001)
 
     def test_extractor_list_auth(self):
         """
@@ -91,6 +128,47 @@ class TestExtractorExtract(FunctionalTestBase):
         assert_equal(enqueue_job.call_count, 1,
                      'Wrong number of extraction tasks.')
 
+    def test_extractor_extract_concurrent(self, enqueue_job):
+        """
+        Concurrent extraction requests for a resource register one task.
+        """
+        res_dict = factories.Resource(format='pdf')
+        get_metadata(res_dict).delete().commit()
+        enqueue_job.reset_mock()
+        start = threading.Event()
+        results = []
+        errors = []
+
+        def request(i):
+            start.wait()
+            try:
+                if i % 2:
+                    result = call_action('extractor_extract_many',
+                                         ids=[res_dict['id']])
+                    results.append(result['results'][res_dict['id']])
+                else:
+                    results.append(call_action('extractor_extract',
+                                               id=res_dict['id']))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                ResourceMetadata.Session.remove()
+
+        threads = [threading.Thread(target=request, args=(i,))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        assert_equal(errors, [])
+        assert_equal(sorted(result['status'] for result in results),
+                     ['inprogress'] * 19 + ['new'])
+        assert_equal({result['task_id'] for result in results},
+                     {get_metadata(res_dict).task_id})
+        assert_equal(enqueue_job.call_count, 1,
+                     'Wrong number of extraction tasks.')
+
     def test_extractor_extract_new_ignored(self, enqueue_job):
         """
         extractor_extract for a new resource with ignored format.
@@ -169,6 +247,39 @@ class TestExtractorExtract(FunctionalTestBase):
         assert_equal(enqueue_job.call_count, 0,
                      'Wrong number of extraction tasks.')
 
+    def test_extractor_extract_dead_task(self, enqueue_job):
+        """
+        extractor_extract for a resource whose task lease has expired.
+        """
+        res_dict = factories.Resource(format='pdf')
+        enqueue_job.reset_mock()
+        metadata = get_metadata(res_dict)
+        old_task_id = metadata.task_id
+        metadata.set_task(old_task_id, -1)
+        metadata.save()
+        result = call_action('extractor_extract', id=res_dict['id'])
+        assert_equal(result['status'], 'update', 'Wrong state')
+        assert_false(result['task_id'] == old_task_id,
+                     'Dead task was not replaced.')
+        assert_equal(enqueue_job.call_count, 1,
+                     'Wrong number of extraction tasks.')
+
+    def test_extractor_extract_dead_task_unchanged(self, enqueue_job):
+        """
+        A dead task does not block the detection of unchanged resources.
+        """
+        res_dict = factories.Resource(format='pdf')
+        fake_process(res_dict)
+        enqueue_job.reset_mock()
+        metadata = get_metadata(res_dict)
+        metadata.set_task('dead-task', -1)
+        metadata.save()
+        result = call_action('extractor_extract', id=res_dict['id'])
+        assert_equal(result['status'], 'unchanged', 'Wrong state')
+        assert_true(result['task_id'] is None, 'Unexpected task ID')
+        assert_equal(enqueue_job.call_count, 0,
+                     'Wrong number of extraction tasks.')
+
     def test_extractor_extract_unexisting(self, enqueue_job):
         """
         extractor_extract for a resource that does not exist.
@@ -245,6 +356,130 @@ class TestExtractorExtract(FunctionalTestBase):
                      'Task ID was not updated.')
         assert_equal(enqueue_job.call_count, 1,
                      'Wrong number of extraction tasks.')
+        assert_true(enqueue_job.call_args[0][1][-1] is True,
+                    'Force flag was not passed to the job.')
+
+
+@mock.patch('ckanext.extractor.logic.action.enqueue_job',
+            side_effect=enqueue_job)
+class TestExtractorExtractMany(FunctionalTestBase):
+
+    def test_extractor_extract_many_package(self, enqueue_job):
+        """
+        extractor_extract_many for the resources of a package.
+        """
+        pkg_dict = factories.Dataset()
+        new = factories.Resource(package_id=pkg_dict['id'], format='pdf')
+        get_metadata(new).delete().commit()
+        unchanged = factories.Resource(package_id=pkg_dict['id'],
+                                       format='pdf')
+        fake_process(unchanged)
+        ignored = factories.Resource(package_id=pkg_dict['id'], format='foo')
+        enqueue_job.reset_mock()
+        result = call_action('extractor_extract_many',
+                             package_id=pkg_dict['name'])
+        results = result['results']
+        assert_equal(results[new['id']]['status'], 'new', 'Wrong state')
+        assert_equal(results[new['id']]['task_id'],
+                     get_metadata(new).task_id, 'Task IDs differ.')
+        assert_equal(results[unchanged['id']],
+                     {'status': 'unchanged', 'task_id': None})
+        assert_equal(results[ignored['id']],
+                     {'status': 'ignored', 'task_id': None})
+        assert_equal(result['not_found'], [])
+        assert_equal(enqueue_job.call_count, 1,
+                     'Wrong number of extraction tasks.')
+        assert_equal(enqueue_job.call_args[0][1][1], [new['id']],
+                     'Wrong resources scheduled.')
+
+    @change_config('ckanext.extractor.high_priority_queue', 'high')
+    @change_config('ckanext.extractor.low_priority_queue', 'low')
+    def test_extractor_extract_many_priority(self, enqueue_job):
+        """
+        extractor_extract_many uses the low priority queue by default.
+        """
+        res_dict = factories.Resource(format='pdf')
+        enqueue_job.reset_mock()
+        call_action('extractor_extract_many', ids=[res_dict['id']],
+                    force=True)
+        assert_equal(enqueue_job.call_args[1]['queue_name'], 'low')
+        call_action('extractor_extract_many', ids=[res_dict['id']],
+                    force=True, priority='high')
+        assert_equal(enqueue_job.call_args[1]['queue_name'], 'high')
+        assert_validation_fails('extractor_extract_many',
+                                'Invalid priority was accepted.',
+                                ids=[res_dict['id']], priority='urgent')
+
+    @change_config('ckanext.extractor.high_priority_queue', 'high')
+    def test_extractor_extract_many_queue(self, enqueue_job):
+        """
+        extractor_extract_many with an explicit queue.
+        """
+        res_dict = factories.Resource(format='pdf')
+        enqueue_job.reset_mock()
+        result = call_action('extractor_extract_many', ids=[res_dict['id']],
+                             force=True, priority='high', queue='custom')
+        assert_equal(enqueue_job.call_args[1]['queue_name'], 'custom')
+        assert_equal(result['task_id'], get_metadata(res_dict).task_id)
+        assert_equal(result['results'][res_dict['id']]['task_id'],
+                     result['task_id'])
+
+    def test_extractor_extract_many_no_enqueue(self, enqueue_job):
+        """
+        extractor_extract_many registers tasks without enqueueing them.
+        """
+        res_dict = factories.Resource(format='pdf')
+        fake_process(res_dict)
+        enqueue_job.reset_mock()
+        result = call_action('extractor_extract_many', {'enqueue': False},
+                             ids=[res_dict['id']])
+        assert_equal(result['task_id'], None)
+        result = call_action('extractor_extract_many', {'enqueue': False},
+                             ids=[res_dict['id']], force=True)
+        assert_equal(result['task_id'], get_metadata(res_dict).task_id)
+        assert_equal(enqueue_job.call_count, 0, 'Job was enqueued.')
+
+    def test_extractor_extract_many_ids(self, enqueue_job):
+        """
+        extractor_extract_many for a list of resource IDs.
+        """
+        res_dicts = [factories.Resource(format='pdf') for _ in range(2)]
+        for res_dict in res_dicts:
+            fake_process(res_dict)
+        enqueue_job.reset_mock()
+        ids = [res_dict['id'] for res_dict in res_dicts]
+        result = call_action('extractor_extract_many',
+                             ids=ids + ['does-not-exist'], force=True)
+        assert_equal(sorted(result['results']), sorted(ids))
+        assert_equal(result['not_found'], ['does-not-exist'])
+        assert_equal(enqueue_job.call_count, 1,
+                     'Wrong number of extraction tasks.')
+        assert_equal(sorted(enqueue_job.call_args[0][1][1]), sorted(ids),
+                     'Wrong resources scheduled.')
+
+    def test_extractor_extract_many_auth(self, enqueue_job):
+        """
+        Authorization for extractor_extract_many.
+        """
+        res_dict = factories.Resource(format='pdf')
+        assert_not_authorized(factories.User(), 'extractor_extract_many',
+                              'Normal user was allowed to '
+                              + 'extractor_extract_many', ids=[res_dict['id']])
+        assert_no_anonymous_access('extractor_extract_many',
+                                   ids=[res_dict['id']])
+        assert_authorized(factories.Sysadmin(), 'extractor_extract_many',
+                          "Sysadmin wasn't allowed to extractor_extract_many",
+                          ids=[res_dict['id']])
+
+    def test_extractor_extract_many_validation(self, enqueue_job):
+        """
+        Input validation for extractor_extract_many.
+        """
+        assert_validation_fails('extractor_extract_many',
+                                'IDs or package ID were not required.')
+        assert_validation_fails('extractor_extract_many',
+                                'Wrong force type was accepted',
+                                ids=['foo'], force='maybe')
 
 
 @mock.patch('ckanext.extractor.logic.action.enqueue_job',
@@ -284,6 +519,28 @@ class TestExtractorShow(FunctionalTestBase):
                      'Wrong resource ID.')
         assert_true(result['task_id'] is None, 'Unexpected task ID.')
 
+    def test_extractor_show_fields(self, enqueue_job):
+        """
+        extractor_show with a selection of fields.
+        """
+        res_dict = factories.Resource(format='pdf')
+        fake_process(res_dict)
+        metadata = get_metadata(res_dict)
+        metadata.meta['fulltext'] = 'foobar'
+        metadata.meta['author'] = 'John Doe'
+        metadata.meta['title'] = 'A title'
+        metadata.save()
+        result = call_action('extractor_show', id=res_dict['id'],
+                             fields=['author', 'title', 'does-not-exist'])
+        assert_equal(result['meta'], {'author': 'John Doe',
+                                      'title': 'A title'})
+        result = call_action('extractor_show', id=res_dict['id'],
+                             fields='author,fulltext', truncate=3)
+        assert_equal(result['meta'], {'author': 'Joh', 'fulltext': 'foo'})
+        result = call_action('extractor_show', id=res_dict['id'],
+                             length_only=True)
+        assert_equal(result['meta'], {'author': 8, 'fulltext': 6, 'title': 7})
+
     def test_extractor_show_auth(self, enqueue_job):
         """
         Authorization for extractor_show.
@@ -300,6 +557,79 @@ class TestExtractorShow(FunctionalTestBase):
         """
         assert_validation_fails('extractor_show',
                                 'ID was not required.')
+        res_dict = factories.Resource(format='pdf')
+        assert_validation_fails('extractor_show',
+                                'Negative truncation was accepted.',
+                                id=res_dict['id'], truncate=-1)
+
+
+@mock.patch('ckanext.extractor.logic.action.enqueue_job',
+            return_value=mock.Mock(id='test-id'))
+class TestExtractorShowMany(FunctionalTestBase):
+
+    def _create_resources(self, pkg_dict):
+        res_dicts = []
+        for i in range(2):
+            res_dict = factories.Resource(package_id=pkg_dict['id'],
+                                          format='pdf')
+            fake_process(res_dict)
+            metadata = get_metadata(res_dict)
+            metadata.meta['fulltext'] = 'foobar {}'.format(i)
+            metadata.meta['author'] = 'John Doe'
+            metadata.save()
+            res_dicts.append(res_dict)
+        return res_dicts
+
+    def test_extractor_show_many_ids(self, enqueue_job):
+        """
+        extractor_show_many for a list of resource IDs.
+        """
+        res_dicts = self._create_resources(factories.Dataset())
+        ids = [res_dict['id'] for res_dict in res_dicts]
+        result = call_action('extractor_show_many',
+                             ids=ids + ['does-not-exist'])
+        assert_equal(sorted(result['results']), sorted(ids))
+        for i, id in enumerate(ids):
+            assert_equal(result['results'][id]['meta'],
+                         {'fulltext': 'foobar {}'.format(i),
+                          'author': 'John Doe'})
+        assert_equal(result['not_found'], ['does-not-exist'])
+
+    def test_extractor_show_many_package(self, enqueue_job):
+        """
+        extractor_show_many for the resources of a package.
+        """
+        pkg_dict = factories.Dataset()
+        res_dicts = self._create_resources(pkg_dict)
+        result = call_action('extractor_show_many', package_id=pkg_dict['id'],
+                             fields='author', truncate=4)
+        for res_dict in res_dicts:
+            assert_equal(result['results'][res_dict['id']]['meta'],
+                         {'author': 'John'})
+        assert_equal(result['not_found'], [])
+
+    def test_extractor_show_many_unexisting_package(self, enqueue_job):
+        """
+        extractor_show_many for a package that does not exist.
+        """
+        assert_raises(NotFound, lambda: call_action('extractor_show_many',
+                      package_id='does-not-exist'))
+
+    def test_extractor_show_many_auth(self, enqueue_job):
+        """
+        Authorization for extractor_show_many.
+        """
+        assert_authorized(factories.User(), 'extractor_show_many',
+                          "Normal user wasn't allowed to extractor_show_many",
+                          ids=['foo'])
+        assert_anonymous_access('extractor_show_many', ids=['foo'])
+
+    def test_extractor_show_many_validation(self, enqueue_job):
+        """
+        Input validation for extractor_show_many.
+        """
+        assert_validation_fails('extractor_show_many',
+                                'IDs or package ID were not required.')
 
 
 @mock.patch('ckanext.extractor.logic.action.enqueue_job',
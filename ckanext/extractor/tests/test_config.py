@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016-2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from fnmatch import fnmatch
+
+import mock
+from nose.tools import assert_false, assert_true
+
+from ckan.tests.helpers import change_config
+
+from ..config import (get, get_queue_names, is_field_indexed,
+                      is_format_indexed, load_config, _matchers)
+from .helpers import assert_equal
+
+
+@mock.patch('ckanext.extractor.config._loaded_ini_path', None)
+@mock.patch('ckanext.extractor.config._register_translator')
+@mock.patch('ckanext.extractor.config.load_environment')
+@mock.patch('ckanext.extractor.config.paste.deploy.appconfig')
+@mock.patch('ckanext.extractor.config.logging.config.fileConfig')
+class TestLoadConfig(object):
+
+    def test_load_config_once(self, file_config, appconfig, load_environment,
+                              register_translator):
+        """
+        The environment is loaded only once per configuration file.
+        """
+        load_config('/foo/bar.ini')
+        load_config('/foo/bar.ini')
+        assert_equal(load_environment.call_count, 1)
+        assert_equal(register_translator.call_count, 2)
+        load_config('/foo/baz.ini')
+        assert_equal(load_environment.call_count, 2)
+
+
+class TestPatternMatching(object):
+
+    @change_config('ckanext.extractor.indexed_formats', 'PDF x?s *-doc')
+    def test_is_format_indexed(self):
+        """
+        Formats are matched case-insensitively against the patterns.
+        """
+        for format in ['pdf', 'Pdf', 'xls', 'XLS', 'ms-doc', '-doc']:
+            assert_true(is_format_indexed(format),
+                        'Format "{}" is not indexed.'.format(format))
+        for format in ['pd', 'pdfx', 'xlsx', 'doc', 'ms-docx']:
+            assert_false(is_format_indexed(format),
+                         'Format "{}" is indexed.'.format(format))
+
+    @change_config('ckanext.extractor.indexed_fields', '')
+    def test_no_patterns(self):
+        """
+        Nothing matches if no patterns are configured.
+        """
+        assert_false(is_field_indexed('fulltext'))
+        assert_false(is_field_indexed(''))
+
+    def test_matcher_recompiled_on_change(self):
+        """
+        The matcher is re-compiled when the setting changes.
+        """
+        @change_config('ckanext.extractor.indexed_fields', 'foo')
+        def check_foo():
+            assert_true(is_field_indexed('foo'))
+            matcher = _matchers['indexed_fields'][1]
+            assert_true(is_field_indexed('foo'))
+            assert_equal(_matchers['indexed_fields'][1], matcher)
+
+        @change_config('ckanext.extractor.indexed_fields', 'bar')
+        def check_bar():
+            assert_false(is_field_indexed('foo'))
+            assert_true(is_field_indexed('bar'))
+
+        check_foo()
+        check_bar()
+
+    @change_config('ckanext.extractor.indexed_fields', 'fulltext author x-* '
+                   + 'dc:* *:title meta:*-count')
+    def test_compiled_matching(self):
+        """
+        Compiled matching gives the same results as matching each pattern.
+
+        See ``benchmarks/matching.py`` for the performance comparison.
+        """
+        fields = ['fulltext', 'Author', 'x-parsed-by', 'dc:creator',
+                  'pdf:title', 'meta:page-count', 'content-type', 'created']
+        for field in fields:
+            assert_equal(is_field_indexed(field), any(fnmatch(field.lower(), p)
+                         for p in get('indexed_fields')))
+
+
+class TestQueueNames(object):
+
+    def test_default_queue_names(self):
+        """
+        Both priorities use the default queue by default.
+        """
+        assert_equal(get_queue_names(), ['default'])
+
+    @change_config('ckanext.extractor.low_priority_queue', 'bulk')
+    def test_queue_names_in_order_of_priority(self):
+        """
+        The high priority queue comes first.
+        """
+        assert_equal(get_queue_names(), ['default', 'bulk'])
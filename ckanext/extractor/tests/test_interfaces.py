@@ -29,7 +29,9 @@ from pylons import config
 from ckan.tests import factories, helpers
 from ckan.plugins import implements, SingletonPlugin, PluginImplementations
 
-from ..interfaces import IExtractorPostprocessor, IExtractorRequest
+from ..interfaces import (IExtractorBackend, IExtractorPostprocessor,
+                          IExtractorRequest)
+from ..lib import download_and_extract
 from ..tasks import extract
 from .helpers import (assert_equal, get_metadata, assert_package_found,
                       assert_package_not_found)
@@ -47,6 +49,10 @@ METADATA =  {
     'created': 'yesterday',
 }
 
+DOWNLOAD = {
+    'hash': 'a-hash',
+}
+
 
 def filter_metadata(d):
     keys = config['ckanext.extractor.indexed_fields'].split()
@@ -103,11 +109,24 @@ class MockBeforeRequest(MockPostprocessor):
         return request
 
 
+class MockBackend(MockPostprocessor):
+    implements(IExtractorBackend, inherit=True)
+
+    def extractor_get_backends(self):
+        return {'mock': self.extract}
+
+    def extract(self, chunks, deadline, content_type, file_name):
+        self.called += 1
+        assert_equal(b''.join(chunks), b'foo')
+        return {'fulltext': 'bar', 'Some_Field': ['value']}
+
+
 MockPostprocessor().disable()
 MockAfterExtractPostprocessor().disable()
 MockAfterSavePostprocessor().disable()
 MockAfterIndexPostprocessor().disable()
 MockBeforeRequest().disable()
+MockBackend().disable()
 
 
 def with_plugin(cls):
@@ -131,7 +150,7 @@ def with_plugin(cls):
 
 @mock.patch('ckanext.extractor.tasks.load_config')
 @mock.patch('ckanext.extractor.tasks.download_and_extract',
-            side_effect=lambda _: METADATA.copy())
+            side_effect=lambda *args: (METADATA.copy(), DOWNLOAD))
 class TestIExtractorPostprocessor(object):
 
     @with_plugin(MockAfterExtractPostprocessor)
@@ -160,19 +179,33 @@ class TestIExtractorPostprocessor(object):
 @mock.patch('ckanext.extractor.tasks.load_config')
 @mock.patch('ckanext.extractor.tasks.toolkit')
 @mock.patch('ckanext.extractor.tasks.search')
-@mock.patch('ckanext.extractor.lib.pysolr.Solr')
-@mock.patch('ckanext.extractor.lib.Session')
+@mock.patch('ckanext.extractor.lib.get_session')
 class TestIExtractorRequest(object):
 
     def setup(self):
         self.res_dict = factories.Resource(**RES_DICT)
 
     @with_plugin(MockBeforeRequest)
-    def test_before_request(self, session, solr, search, toolkit, load_config, plugin):
+    def test_before_request(self, get_session, search, toolkit, load_config, plugin):
         extract(config['__file__'], self.res_dict)
         assert_equal(plugin.called, 1)
-        assert_true(session.called)
+        session = get_session.return_value
+        assert_true(session.send.called)
 
-        name, args, kwargs = session.mock_calls[1]
-        assert_equal(name, '().send')
+        args, kwargs = session.send.call_args
         assert_equal(args[0].url, 'http://test-url.example.com/file.pdf')
+
+
+class TestIExtractorBackend(object):
+
+    @mock.patch('ckanext.extractor.lib.get_session')
+    @with_plugin(MockBackend)
+    @helpers.change_config('ckanext.extractor.backend', 'mock')
+    def test_backend(self, get_session, plugin):
+        response = get_session.return_value.send.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'foo']
+        metadata, download = download_and_extract('http://does-not-matter')
+        assert_equal(plugin.called, 1)
+        assert_equal(metadata, {'fulltext': 'bar', 'some-field': 'value'})
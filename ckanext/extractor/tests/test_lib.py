@@ -19,14 +19,26 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import hashlib
 import os.path
+import time
 
-from nose.tools import assert_true
+import mock
+from nose.tools import assert_raises, assert_true
+from requests import Request
+from requests.cookies import create_cookie, MockRequest
 
-from ..lib import clean_metadatum, download_and_extract
+from ckan.tests.helpers import change_config
+
+from ..lib import (_limited, _start_watchdog, clean_metadatum,
+                   download_and_extract, ExtractionError, extract_with_python,
+                   get_backend, get_session, LimitExceeded, ResourceUnchanged)
 from .helpers import assert_equal, SimpleServer
 
 
+PDF_PATH = os.path.join(os.path.dirname(__file__), 'test.pdf')
+
+
 class TestDownloadAndExtract(object):
 
     PORT = 8000
@@ -42,10 +54,143 @@ class TestDownloadAndExtract(object):
 
     def test_download_and_extract(self):
         pdf_url = 'http://localhost:{port}/test.pdf'.format(port=self.PORT)
-        metadata = download_and_extract(pdf_url)
+        metadata, download = download_and_extract(pdf_url)
+        assert_true('Foobarium' in metadata['fulltext'], 'Incorrect fulltext.')
+        assert_equal(metadata['content-type'], 'application/pdf')
+        with open(PDF_PATH, 'rb') as f:
+            data = f.read()
+        assert_equal(download['hash'], hashlib.sha256(data).hexdigest())
+        assert_equal(download['size'], len(data))
+
+    @mock.patch('ckanext.extractor.lib.tempfile')
+    def test_download_and_extract_streaming(self, tempfile_mock):
+        pdf_url = 'http://localhost:{port}/test.pdf'.format(port=self.PORT)
+        metadata, download = download_and_extract(pdf_url)
+        assert_true('Foobarium' in metadata['fulltext'], 'Incorrect fulltext.')
+        assert_true(not tempfile_mock.SpooledTemporaryFile.called,
+                    'File was buffered.')
+
+    @change_config('ckanext.extractor.max_file_size', '100')
+    def test_download_and_extract_max_file_size(self):
+        pdf_url = 'http://localhost:{port}/test.pdf'.format(port=self.PORT)
+        with assert_raises(LimitExceeded):
+            download_and_extract(pdf_url)
+
+    @change_config('ckanext.extractor.job_timeout', '0.000001')
+    def test_download_and_extract_job_timeout(self):
+        pdf_url = 'http://localhost:{port}/test.pdf'.format(port=self.PORT)
+        with assert_raises(LimitExceeded):
+            download_and_extract(pdf_url)
+
+    def test_download_and_extract_unchanged(self):
+        pdf_url = 'http://localhost:{port}/test.pdf'.format(port=self.PORT)
+        metadata, download = download_and_extract(pdf_url)
+        with assert_raises(ResourceUnchanged):
+            download_and_extract(pdf_url, download)
+
+
+@mock.patch('ckanext.extractor.lib.get_session')
+def test_download_and_extract_not_modified(session):
+    url = 'http://does-not-matter/test.pdf'
+    previous = {
+        'url': url,
+        'hash': 'a-hash',
+        'etag': '"old-etag"',
+        'last_modified': 'Sat, 01 Jan 2000 00:00:00 GMT',
+    }
+    session.return_value.send.return_value = mock.Mock(
+        status_code=304, headers={'ETag': '"new-etag"'})
+    with assert_raises(ResourceUnchanged) as cm:
+        download_and_extract(url, previous)
+    request = session.return_value.send.call_args[0][0]
+    assert_equal(request.headers['If-None-Match'], previous['etag'])
+    assert_equal(request.headers['If-Modified-Since'],
+                 previous['last_modified'])
+    assert_equal(cm.exception.download, dict(previous, etag='"new-etag"'))
+    assert_true(not session.return_value.post.called, 'Solr was called.')
+
+    # No conditional request if the URL has changed
+    session.return_value.send.return_value = mock.MagicMock(status_code=200,
+                                                            headers={})
+    download_and_extract('http://does-not-matter/other.pdf', previous)
+    request = session.return_value.send.call_args[0][0]
+    assert_true('If-None-Match' not in request.headers)
+
+
+def test_watchdog():
+    response = mock.Mock()
+    watchdog = _start_watchdog(response, time.time() + 0.05)
+    watchdog.join(1)
+    assert_true(response.raw._connection.sock.shutdown.called,
+                'Download was not aborted.')
+
+    # Cancelled watchdogs don't abort the download
+    response = mock.Mock()
+    watchdog = _start_watchdog(response, time.time() + 0.05)
+    watchdog.cancel()
+    watchdog.join(1)
+    assert_true(not response.raw._connection.sock.shutdown.called,
+                'Download was aborted.')
+
+
+def test_limited_aborted_download():
+    def chunks():
+        yield b'foo'
+        time.sleep(0.05)
+        # Aborted downloads end prematurely or fail
+        raise IOError('Socket was shut down')
+    with assert_raises(LimitExceeded):
+        list(_limited(chunks(), 0, time.time() + 0.01))
+    with assert_raises(LimitExceeded):
+        list(_limited(iter([b'foo']), 0, time.time() - 1))
+
+
+@mock.patch('ckanext.extractor.lib._session', None)
+@mock.patch('ckanext.extractor.lib.os.getpid', return_value=1)
+def test_get_session(getpid):
+    session = get_session()
+    assert_true(get_session() is session, 'Session was not reused.')
+    getpid.return_value = 2
+    assert_true(get_session() is not session,
+                'Session was shared with another process.')
+
+
+@mock.patch('ckanext.extractor.lib._session', None)
+def test_get_session_cookies():
+    session = get_session()
+    cookie = create_cookie('foo', 'bar', domain='example.com')
+    request = MockRequest(Request('GET', 'http://example.com/').prepare())
+    session.cookies.set_cookie_if_ok(cookie, request)
+    assert_equal(len(session.cookies), 0, 'Cookie was stored.')
+
+
+class TestExtractWithPython(object):
+
+    def test_pdf(self):
+        with open(PDF_PATH, 'rb') as f:
+            chunks = [f.read()]
+        metadata = extract_with_python(iter(chunks), time.time() + 60,
+                                       'application/pdf', 'test.pdf')
         assert_true('Foobarium' in metadata['fulltext'], 'Incorrect fulltext.')
         assert_equal(metadata['content-type'], 'application/pdf')
 
+    def test_text(self):
+        chunks = [b'Foo', 'bär'.encode('utf-8')]
+        metadata = extract_with_python(iter(chunks), time.time() + 60,
+                                       'text/plain; charset=utf-8', 'x.txt')
+        assert_equal(metadata['fulltext'], 'Foobär')
+
+    def test_unsupported_format(self):
+        with assert_raises(ExtractionError):
+            extract_with_python(iter([b'foo']), time.time() + 60,
+                                'application/x-foo', 'x.foo')
+
+
+def test_get_backend():
+    assert_equal(get_backend('python'), extract_with_python)
+    with assert_raises(ValueError):
+        get_backend('does-not-exist')
+
 
 def test_clean_metadatum():
     assert_equal(clean_metadatum('X_y', ['X_y']), ('x-y', 'X_y'))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016-2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from sqlalchemy import inspect
+
+from ckan.model.meta import metadata as db_metadata
+from ckan.tests import factories
+from ckan.tests.helpers import change_config, FunctionalTestBase
+
+from ..model import (create_tables, migrate_storage, reap_tasks,
+                     ResourceMetadata, ResourceMetadatum,
+                     RESOURCE_METADATUM_TABLE_NAME)
+from .helpers import assert_equal
+
+
+METADATA = {
+    'fulltext': 'foobar',
+    'author': 'john_doe',
+}
+
+
+def _store_metadata():
+    res_dict = factories.Resource(url='does-not-matter', format='pdf')
+    metadata = ResourceMetadata.create(resource_id=res_dict['id'])
+    metadata.meta.update(METADATA)
+    metadata.save()
+    return res_dict['id']
+
+
+def _get_meta(resource_id):
+    ResourceMetadata.Session.expire_all()
+    return dict(ResourceMetadata.one(resource_id=resource_id).meta)
+
+
+class TestJSONStorage(FunctionalTestBase):
+
+    @change_config('ckanext.extractor.storage', 'json')
+    def test_json_storage(self):
+        """
+        Metadata are stored in a single JSON document.
+        """
+        resource_id = _store_metadata()
+        assert_equal(_get_meta(resource_id), METADATA)
+        assert_equal(ResourceMetadatum.filter_by(
+                     resource_id=resource_id).count(), 0,
+                     'Metadata were stored in separate rows.')
+        metadata = ResourceMetadata.one(resource_id=resource_id)
+        metadata.replace_meta({'fulltext': 'new'})
+        metadata.save()
+        assert_equal(_get_meta(resource_id), {'fulltext': 'new'})
+        result = metadata.as_dict()
+        assert_equal(result['meta'], {'fulltext': 'new'})
+        assert 'meta_json' not in result, 'Internal column was exposed.'
+
+    def test_migrate_storage(self):
+        """
+        Metadata can be moved between the storages in both directions.
+        """
+        resource_id = _store_metadata()
+        migrate_storage('json')
+        assert_equal(ResourceMetadatum.filter_by(
+                     resource_id=resource_id).count(), 0,
+                     'Metadata rows were not removed.')
+
+        @change_config('ckanext.extractor.storage', 'json')
+        def check_json():
+            assert_equal(_get_meta(resource_id), METADATA)
+
+        check_json()
+        migrate_storage('table')
+        assert_equal(_get_meta(resource_id), METADATA)
+        assert_equal(ResourceMetadata.one(resource_id=resource_id).meta_json,
+                     None, 'JSON document was not removed.')
+
+
+class TestCreateTables(FunctionalTestBase):
+
+    def test_add_unique_index(self):
+        """
+        Duplicates are removed before the unique index is added.
+        """
+        resource_id = _store_metadata()
+        engine = db_metadata.bind
+        index_name = RESOURCE_METADATUM_TABLE_NAME + '_resource_id_key_idx'
+        engine.execute('DROP INDEX {}'.format(index_name))
+        engine.execute("""
+            INSERT INTO {} (resource_id, key, value)
+            VALUES (%s, 'author', 'jane_doe')
+        """.format(RESOURCE_METADATUM_TABLE_NAME), resource_id)
+        create_tables()
+        indexes = inspect(engine).get_indexes(RESOURCE_METADATUM_TABLE_NAME)
+        assert index_name in [i['name'] for i in indexes], 'Index not added.'
+        assert_equal(_get_meta(resource_id),
+                     dict(METADATA, author='jane_doe'))
+
+
+class TestTaskLeases(FunctionalTestBase):
+
+    def test_reap_tasks(self):
+        """
+        Only tasks with expired leases are reaped by default.
+        """
+        dead = ResourceMetadata.create(resource_id=factories.Resource()['id'])
+        dead.set_task('dead-task', -1)
+        alive = ResourceMetadata.create(
+            resource_id=factories.Resource()['id'])
+        alive.set_task('alive-task', 60)
+        ResourceMetadata.Session.commit()
+        assert_equal(reap_tasks(), 1)
+        ResourceMetadata.Session.expire_all()
+        assert_equal(dead.task_id, None)
+        assert_equal(alive.task_id, 'alive-task')
+        assert_equal(reap_tasks(expired_only=False), 1)
+        ResourceMetadata.Session.expire_all()
+        assert_equal(alive.task_id, None)
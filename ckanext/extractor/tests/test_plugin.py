@@ -20,8 +20,10 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import datetime
+import json
 
 import mock
+from nose.tools import assert_false
 from sqlalchemy.orm.exc import NoResultFound
 
 from ckan.model import Package
@@ -32,7 +34,8 @@ from .helpers import (assert_equal, get_metadata, assert_metadata,
                       assert_no_metadata, assert_package_found,
                       assert_package_not_found)
 from ..model import ResourceMetadata
-from ..plugin import ExtractorPlugin
+from ..plugin import (_prefetched, ExtractorPlugin, prefetch_metadata,
+                      SOLR_FIELD)
 
 
 RES_DICT =  {
@@ -48,19 +51,26 @@ METADATA =  {
 
 
 def enqueue_job(name, args, **opts):
-    res_dict = args[1]
-    try:
-        metadata = get_metadata(res_dict)
-    except NoResultFound:
-        metadata = ResourceMetadata.create(resource_id=res_dict['id'])
-    metadata.last_format = res_dict['format']
-    metadata.last_url = res_dict['url']
-    metadata.last_extracted = datetime.datetime.now()
-    metadata.task_id = None
-    metadata.meta.update(METADATA)
-    metadata.save()
-    pkg_dict = helpers.call_action('package_show', id=res_dict['package_id'])
-    index_for('package').update_dict(pkg_dict)
+    if isinstance(args[1], list):
+        # Batch job with a list of resource IDs
+        res_dicts = [helpers.call_action('resource_show', id=id)
+                     for id in args[1]]
+    else:
+        res_dicts = [args[1]]
+    for res_dict in res_dicts:
+        try:
+            metadata = get_metadata(res_dict)
+        except NoResultFound:
+            metadata = ResourceMetadata.create(resource_id=res_dict['id'])
+        metadata.last_format = res_dict['format']
+        metadata.last_url = res_dict['url']
+        metadata.last_extracted = datetime.datetime.now()
+        metadata.task_id = None
+        metadata.meta.update(METADATA)
+        metadata.save()
+        pkg_dict = helpers.call_action('package_show',
+                                       id=res_dict['package_id'])
+        index_for('package').update_dict(pkg_dict)
     return mock.Mock(id=None)
 
 
@@ -139,3 +149,49 @@ class TestHooks(helpers.FunctionalTestBase):
         helpers.call_action('package_update', {'user': user['id']}, **pkg_dict)
         assert_no_metadata(res_dict)
 
+
+@mock.patch('ckanext.extractor.logic.action.enqueue_job',
+            side_effect=enqueue_job)
+class TestBeforeIndex(helpers.FunctionalTestBase):
+
+    def test_before_index_multiple_resources(self, enqueue_job):
+        """
+        Metadata of all indexed resources of a package are indexed.
+        """
+        pkg_dict = factories.Dataset()
+        res_dicts = [factories.Resource(package_id=pkg_dict['id'], **RES_DICT)
+                     for _ in range(3)]
+        ignored = factories.Resource(package_id=pkg_dict['id'], url='foo',
+                                     format='not-indexed')
+        pkg_dict = helpers.call_action('package_show', id=pkg_dict['id'])
+        result = ExtractorPlugin().before_index(
+            {'data_dict': json.dumps(pkg_dict)})
+        for res_dict in res_dicts:
+            for key in ('fulltext', 'author'):
+                field = SOLR_FIELD.format(id=res_dict['id'], key=key)
+                assert_equal(result.get(field), METADATA[key],
+                             'Wrong value for "{}".'.format(field))
+            field = SOLR_FIELD.format(id=res_dict['id'], key='created')
+            assert field not in result, 'Unindexed field was indexed.'
+        for field in result:
+            assert ignored['id'] not in field, \
+                'Unindexed resource was indexed.'
+
+    def test_before_index_prefetched(self, enqueue_job):
+        """
+        Prefetched metadata are used and discarded by before_index.
+        """
+        res_dict = factories.Resource(**RES_DICT)
+        pkg_dict = helpers.call_action('package_show',
+                                       id=res_dict['package_id'])
+        prefetch_metadata([pkg_dict['id']])
+        try:
+            with mock.patch.object(ResourceMetadata, 'get_many') as get_many:
+                result = ExtractorPlugin().before_index(
+                    {'data_dict': json.dumps(pkg_dict)})
+            assert_false(get_many.called, 'Metadata were not prefetched.')
+            field = SOLR_FIELD.format(id=res_dict['id'], key='fulltext')
+            assert_equal(result.get(field), METADATA['fulltext'])
+            assert_false(_prefetched, 'Prefetched metadata were not removed.')
+        finally:
+            prefetch_metadata([])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2016-2018 Stadt Karlsruhe (www.karlsruhe.de)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import datetime
+
+from nose.tools import assert_false, assert_true
+
+from ckan.tests.helpers import change_config, FunctionalTestBase
+
+from ..model import QueuedJob
+from ..queue import cancel, claim, enqueue, enqueue_unique, work
+from ..tasks import enqueue_job
+from .helpers import assert_equal
+
+
+# Arguments of the calls of ``record``
+CALLS = []
+
+
+def record(*args):
+    CALLS.append(args)
+
+
+def fail():
+    raise ValueError('Job failed')
+
+
+class TestDatabaseQueue(FunctionalTestBase):
+
+    def setup(self):
+        super(TestDatabaseQueue, self).setup()
+        QueuedJob.Session.query(QueuedJob).delete()
+        QueuedJob.Session.commit()
+        del CALLS[:]
+
+    def test_claim(self):
+        """
+        Each job is claimed only once, oldest first.
+        """
+        first = enqueue(record, ['first']).id
+        second = enqueue(record, ['second']).id
+        QueuedJob.Session.commit()
+        assert_equal(claim('worker-1').id, first)
+        assert_equal(claim('worker-2').id, second)
+        assert_true(claim('worker-3') is None, 'Job was claimed twice.')
+        assert_equal(QueuedJob.Session.query(QueuedJob).get(first).worker,
+                     'worker-1')
+
+    def test_claim_priority(self):
+        """
+        Jobs are claimed from the queues in the order of their priority.
+        """
+        low = enqueue(record, ['low'], queue_name='low').id
+        high = enqueue(record, ['high'], queue_name='high').id
+        enqueue(record, ['other'], queue_name='other')
+        QueuedJob.Session.commit()
+        assert_equal(claim('worker-1', ['high', 'low']).id, high)
+        assert_equal(claim('worker-1', ['high', 'low']).id, low)
+        assert_true(claim('worker-1', ['high', 'low']) is None,
+                    'Job from another queue was claimed.')
+
+    def test_expired_claim(self):
+        """
+        Jobs whose claims have expired can be claimed again.
+        """
+        job_id = enqueue(record, ['first']).id
+        QueuedJob.Session.commit()
+        assert_equal(claim('worker-1').id, job_id)
+        assert_true(claim('worker-2') is None, 'Job was claimed twice.')
+        job = QueuedJob.Session.query(QueuedJob).get(job_id)
+        job.claim_expires = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=1)
+        QueuedJob.Session.commit()
+        assert_equal(claim('worker-2').id, job_id)
+        assert_equal(QueuedJob.Session.query(QueuedJob).get(job_id).worker,
+                     'worker-2')
+
+    def test_cancel(self):
+        """
+        Only unclaimed jobs can be cancelled.
+        """
+        first = enqueue(record, ['first']).id
+        second = enqueue(record, ['second']).id
+        QueuedJob.Session.commit()
+        claim('worker-1')
+        assert_false(cancel(first), 'Claimed job was cancelled.')
+        assert_true(cancel(second), 'Unclaimed job was not cancelled.')
+        QueuedJob.Session.commit()
+        assert_equal([job.id for job in QueuedJob.Session.query(QueuedJob)],
+                     [first])
+
+    def test_enqueue_unique(self):
+        """
+        Only one unclaimed job with the same key can exist.
+        """
+        first = enqueue_unique(record, ['first'], 'key')
+        assert_true(enqueue_unique(record, ['second'], 'key') is None,
+                    'Duplicate job was enqueued.')
+        other = enqueue_unique(record, ['other'], 'other-key')
+        QueuedJob.Session.commit()
+        assert_equal(claim('worker-1').id, first)
+        # Once the job has been claimed a new one can be added
+        third = enqueue_unique(record, ['third'], 'key')
+        QueuedJob.Session.commit()
+        assert_true(third is not None, 'Job was not enqueued.')
+        assert_equal(claim('worker-1').id, other)
+        assert_equal(claim('worker-1').id, third)
+
+    def test_work(self):
+        """
+        A burst worker processes all jobs, even if some of them fail.
+        """
+        enqueue(record, ['first', 1])
+        enqueue(fail)
+        enqueue(record, ['second', 2])
+        QueuedJob.Session.commit()
+        work(burst=True)
+        assert_equal(CALLS, [('first', 1), ('second', 2)])
+        assert_equal(QueuedJob.Session.query(QueuedJob).count(), 0,
+                     'Jobs were not removed.')
+
+    @change_config('ckanext.extractor.queue', 'database')
+    def test_enqueue_job(self):
+        """
+        enqueue_job uses the database queue if configured.
+        """
+        job = enqueue_job(record, ['foo'], title='A title')
+        QueuedJob.Session.commit()
+        job = QueuedJob.Session.query(QueuedJob).get(job.id)
+        assert_equal(job.function, record.__module__ + '.record')
+        assert_equal(job.args, ['foo'])
+        assert_equal(job.title, 'A title')
+        assert_equal(job.queue, 'default')
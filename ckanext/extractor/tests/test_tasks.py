@@ -25,7 +25,8 @@ import re
 
 import mock
 from pylons import config
-from nose.tools import assert_false, assert_true
+from nose.tools import assert_false, assert_raises, assert_true
+import redis
 from requests.exceptions import RequestException
 
 from ckan.lib import search
@@ -33,10 +34,14 @@ from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckan.tests.helpers import FunctionalTestBase
 
-from ..tasks import extract
-from .helpers import (assert_equal, assert_time_span, get_metadata,
-                      assert_package_found, assert_package_not_found,
-                      recorded_logs)
+from ..lib import LimitExceeded, ResourceUnchanged
+from ..model import ResourceMetadata, ResourceMetadatum
+from ..tasks import (_get_rq_queue, cancel_job, enqueue_job, extract,
+                     extract_many, PENDING_REINDEX_KEY, REINDEX_JOB_KEY,
+                     reindex)
+from .helpers import (assert_equal, assert_no_metadata, assert_time_span,
+                      get_metadata, assert_package_found,
+                      assert_package_not_found, recorded_logs)
 
 
 RES_DICT =  {
@@ -50,9 +55,16 @@ METADATA =  {
     'created': 'yesterday',
 }
 
+DOWNLOAD = {
+    'url': RES_DICT['url'],
+    'hash': 'a-hash',
+    'etag': '"an-etag"',
+    'last_modified': 'Sat, 01 Jan 2000 00:00:00 GMT',
+}
+
 
 @mock.patch('ckanext.extractor.tasks.download_and_extract',
-            return_value=METADATA)
+            return_value=(METADATA, DOWNLOAD))
 @mock.patch('ckanext.extractor.tasks.load_config')
 class TestMetadataExtractTask(FunctionalTestBase):
 
@@ -74,6 +86,7 @@ class TestMetadataExtractTask(FunctionalTestBase):
                      'Wrong last_format')
         assert_equal(metadata.last_url, res_dict['url'], 'Wrong last_url.')
         assert_true(metadata.task_id is None, 'Unexpected task ID.')
+        assert_true(metadata.last_error is None, 'Unexpected error.')
         assert_time_span(metadata.last_extracted, max=5)
         assert_package_found(METADATA['fulltext'], res_dict['package_id'],
                              'Metadata not indexed.')
@@ -117,6 +130,78 @@ class TestMetadataExtractTask(FunctionalTestBase):
         assert_package_not_found(METADATA['created'], res_dict['package_id'],
                                  'Wrong metadata indexed.')
 
+    def test_update_only_changed_fields(self, lc_mock, dae_mock):
+        """
+        Unchanged metadata fields are not rewritten.
+        """
+        res_dict = factories.Resource(**RES_DICT)
+        extract(config['__file__'], res_dict)
+
+        def get_ids():
+            return {m.key: m.id for m in
+                    ResourceMetadatum.filter_by(resource_id=res_dict['id'])}
+
+        old_ids = get_ids()
+        dae_mock.return_value = (dict(METADATA, author='jane_doe'),
+                                 {'hash': 'another-hash'})
+        extract(config['__file__'], res_dict)
+        assert_equal(get_ids(), old_ids, 'Metadata rows were re-created.')
+        metadata = get_metadata(res_dict)
+        assert_equal(metadata.meta['author'], 'jane_doe', 'Wrong author.')
+        assert_equal(metadata.meta['fulltext'], METADATA['fulltext'],
+                     'Wrong fulltext.')
+
+    @mock.patch('ckanext.extractor.tasks.search')
+    def test_unchanged_file(self, search_mock, lc_mock, dae_mock):
+        """
+        Metadata is not updated if the file is unchanged.
+        """
+        res_dict = factories.Resource(**RES_DICT)
+        extract(config['__file__'], res_dict)
+        metadata = get_metadata(res_dict)
+        assert_equal(metadata.last_hash, DOWNLOAD['hash'], 'Wrong hash.')
+        assert_equal(metadata.last_etag, DOWNLOAD['etag'], 'Wrong ETag.')
+        assert_equal(metadata.last_modified, DOWNLOAD['last_modified'],
+                     'Wrong Last-Modified.')
+        search_mock.reset_mock()
+        dae_mock.side_effect = ResourceUnchanged(dict(DOWNLOAD,
+                                                      etag='"new-etag"'))
+        extract(config['__file__'], res_dict)
+        assert_equal(dae_mock.call_args[0][1], DOWNLOAD,
+                     'Previous download was not passed.')
+        metadata = get_metadata(res_dict)
+        assert_equal(metadata.meta['fulltext'], METADATA['fulltext'],
+                     'Metadata was changed.')
+        assert_equal(metadata.last_etag, '"new-etag"', 'ETag not updated.')
+        assert_true(metadata.task_id is None, 'Unexpected task ID.')
+        search_mock.rebuild.assert_not_called()
+
+    def test_ignored_format(self, lc_mock, dae_mock):
+        """
+        Resources whose format is not indexed anymore are skipped.
+        """
+        res_dict = factories.Resource(url='does-not-matter', format='foo')
+        ResourceMetadata.create(resource_id=res_dict['id'])
+        assert_true(extract(config['__file__'], res_dict) is None,
+                    'Resource was not skipped.')
+        assert_false(dae_mock.called, 'Resource was downloaded.')
+        assert_no_metadata(res_dict)
+
+        ResourceMetadata.create(resource_id=res_dict['id'])
+        extract_many(config['__file__'], [res_dict['id']])
+        assert_false(dae_mock.called, 'Resource was downloaded.')
+        assert_no_metadata(res_dict)
+
+    def test_forced_unchanged_file(self, lc_mock, dae_mock):
+        """
+        Forced extractions ignore the previous download.
+        """
+        res_dict = factories.Resource(**RES_DICT)
+        extract(config['__file__'], res_dict)
+        extract(config['__file__'], res_dict, force=True)
+        assert_true(dae_mock.call_args[0][1] is None,
+                    'Previous download was passed.')
+
     def test_download_errors(self, lc_mock, dae_mock):
         """
         Handling of errors during resource downloading.
@@ -127,6 +212,23 @@ class TestMetadataExtractTask(FunctionalTestBase):
             extract(config['__file__'], res_dict)
         logs.assert_log('warning', re.escape(res_dict['url']))
         logs.assert_log('warning', 'OH NOES')
+        metadata = get_metadata(res_dict)
+        assert_true('OH NOES' in metadata.last_error, 'Error not recorded.')
+        assert_true(metadata.task_id is None, 'Unexpected task ID.')
+
+    def test_limit_exceeded(self, lc_mock, dae_mock):
+        """
+        Handling of downloads or extractions that exceed a limit.
+        """
+        dae_mock.side_effect = LimitExceeded('Too big')
+        res_dict = factories.Resource(**RES_DICT)
+        with recorded_logs() as logs:
+            extract(config['__file__'], res_dict)
+        logs.assert_log('warning', 'Too big')
+        metadata = get_metadata(res_dict)
+        assert_equal(metadata.last_error, 'Too big', 'Error not recorded.')
+        assert_true(metadata.task_id is None, 'Unexpected task ID.')
+        assert_equal(dict(metadata.meta), {}, 'Unexpected metadata.')
 
     def test_extraction_from_private_dataset(self, lc_mock, dae_mock):
         """
@@ -141,15 +243,37 @@ class TestMetadataExtractTask(FunctionalTestBase):
         logs.assert_log('debug', 'private')
         dae_mock.assert_not_called()
 
+    def test_current_resource_data(self, lc_mock, dae_mock):
+        """
+        The resource data is re-read when the task starts.
+        """
+        res_dict = factories.Resource(**RES_DICT)
+        extract(config['__file__'], dict(res_dict, url='outdated-url'))
+        assert_equal(dae_mock.call_args[0][0], res_dict['url'])
+        assert_equal(get_metadata(res_dict).last_url, res_dict['url'])
+
+    def test_superseded_task(self, lc_mock, dae_mock):
+        """
+        A task skips resources that are registered for a newer task.
+        """
+        res_dict = factories.Resource(**RES_DICT)
+        metadata = get_metadata(res_dict)
+        metadata.set_task('new-task', 60)
+        metadata.save()
+        assert_true(extract(config['__file__'], res_dict, 'old-task') is None,
+                    'Superseded task was not skipped.')
+        dae_mock.assert_not_called()
+        assert_equal(get_metadata(res_dict).task_id, 'new-task')
+
     def test_multiple_values_for_the_same_field(self, lc_mock, dae_mock):
         """
         Handling of multiple values for the same metadata field.
         """
         # See https://github.com/stadt-karlsruhe/ckanext-extractor/issues/11
-        dae_mock.return_value = {
+        dae_mock.return_value = ({
             'fulltext': 'foobar',
             'author': ['john_doe', 'jane_doe'],
-        }
+        }, DOWNLOAD)
         res_dict = factories.Resource(**RES_DICT)
         with recorded_logs() as logs:
             extract(config['__file__'], res_dict)
@@ -170,7 +294,7 @@ class TestMetadataExtractTask(FunctionalTestBase):
             toolkit.get_action('package_patch')({'user': sysadmin['name']},
                                                 {'id': res_dict['package_id'],
                                                  'title': 'A changed title'})
-            return {'fulltext': 'foobar'}
+            return {'fulltext': 'foobar'}, DOWNLOAD
 
         dae_mock.side_effect = download_and_extract
         extract(config['__file__'], res_dict)
@@ -182,3 +306,110 @@ class TestMetadataExtractTask(FunctionalTestBase):
         indexed_pkg_dict = search.show(res_dict['package_id'])
         assert_equal(indexed_pkg_dict['title'], 'A changed title')
 
+    @mock.patch('ckanext.extractor.tasks._is_job_queued')
+    @mock.patch('ckanext.extractor.tasks.enqueue_job')
+    @mock.patch('ckanext.extractor.tasks.search')
+    @mock.patch('ckanext.extractor.tasks.get_current_job')
+    def test_coalesced_reindex(self, gcj_mock, search_mock, ej_mock,
+                               ijq_mock, lc_mock, dae_mock):
+        """
+        Extractions of multiple resources of a package cause one reindex.
+        """
+        connection = redis.StrictRedis.from_url(
+            config.get('ckan.redis.url', 'redis://localhost:6379/0'))
+        gcj_mock.return_value = mock.Mock(connection=connection)
+        ej_mock.return_value = mock.Mock(id='reindex-job')
+        ijq_mock.side_effect = lambda job_id, _: job_id == 'reindex-job'
+        pkg_dict = factories.Dataset()
+        res_dicts = [factories.Resource(package_id=pkg_dict['id'], **RES_DICT)
+                     for _ in range(3)]
+        key = PENDING_REINDEX_KEY.format(package_id=pkg_dict['id'])
+        connection.delete(key)
+        connection.delete(REINDEX_JOB_KEY.format(package_id=pkg_dict['id']))
+        for res_dict in res_dicts:
+            extract(config['__file__'], res_dict)
+        search_mock.rebuild.assert_not_called()
+        assert_equal(ej_mock.call_count, 1, 'Wrong number of reindex jobs.')
+        assert_equal(ej_mock.call_args[0][1],
+                     (config['__file__'], pkg_dict['id']))
+
+        reindex(config['__file__'], pkg_dict['id'])
+        search_mock.rebuild.assert_called_once_with(package_id=pkg_dict['id'])
+        assert_false(connection.exists(key), 'Pending resources not cleared.')
+
+        # A second reindex job for the same package does nothing
+        reindex(config['__file__'], pkg_dict['id'])
+        assert_equal(search_mock.rebuild.call_count, 1,
+                     'Package was re-indexed twice.')
+
+    @mock.patch('ckanext.extractor.tasks._is_job_queued', return_value=False)
+    @mock.patch('ckanext.extractor.tasks.enqueue_job')
+    @mock.patch('ckanext.extractor.tasks.search')
+    @mock.patch('ckanext.extractor.tasks.get_current_job')
+    def test_failed_reindex(self, gcj_mock, search_mock, ej_mock, ijq_mock,
+                            lc_mock, dae_mock):
+        """
+        Pending resources are kept if the reindex fails.
+        """
+        connection = redis.StrictRedis.from_url(
+            config.get('ckan.redis.url', 'redis://localhost:6379/0'))
+        gcj_mock.return_value = mock.Mock(connection=connection)
+        res_dict = factories.Resource(**RES_DICT)
+        key = PENDING_REINDEX_KEY.format(package_id=res_dict['package_id'])
+        connection.delete(key)
+        extract(config['__file__'], res_dict)
+        search_mock.rebuild.side_effect = ValueError('Solr is down')
+        with assert_raises(ValueError):
+            reindex(config['__file__'], res_dict['package_id'])
+        assert_equal(connection.smembers(key), {res_dict['id']})
+
+        # Since the failed job is not queued anymore a new one is enqueued
+        extract(config['__file__'], res_dict, force=True)
+        assert_equal(ej_mock.call_count, 2, 'Reindex job was not enqueued.')
+        connection.delete(key)
+
+    @mock.patch('ckanext.extractor.tasks.search')
+    def test_extract_many(self, search_mock, lc_mock, dae_mock):
+        """
+        Multiple resources are extracted in a single job.
+        """
+        def download_and_extract(url, previous):
+            if url == 'broken':
+                raise ValueError('Something went wrong')
+            return METADATA, DOWNLOAD
+
+        dae_mock.side_effect = download_and_extract
+        pkg_dicts = [factories.Dataset() for _ in range(2)]
+        res_dicts = [factories.Resource(package_id=pkg_dict['id'], **RES_DICT)
+                     for pkg_dict in pkg_dicts for _ in range(2)]
+        broken = factories.Resource(package_id=pkg_dicts[0]['id'],
+                                    url='broken', format='pdf')
+        ids = [res_dict['id'] for res_dict in res_dicts] + [broken['id']]
+        extract_many(config['__file__'], ids + ['does-not-exist'])
+        for res_dict in res_dicts:
+            metadata = get_metadata(res_dict)
+            assert_equal(metadata.meta['fulltext'], METADATA['fulltext'],
+                         'Wrong fulltext.')
+            assert_true(metadata.task_id is None, 'Unexpected task ID.')
+        metadata = get_metadata(broken)
+        assert_equal(metadata.last_error,
+                     'ValueError: Something went wrong', 'Wrong error.')
+        assert_true(metadata.task_id is None, 'Unexpected task ID.')
+        assert_equal(sorted(c[1]['package_id'] for c in
+                     search_mock.rebuild.call_args_list),
+                     sorted(pkg_dict['id'] for pkg_dict in pkg_dicts),
+                     'Packages were not re-indexed once each.')
+
+
+def test_cancel_rq_job():
+    """
+    Queued RQ jobs can be cancelled.
+    """
+    rq_queue = _get_rq_queue()
+    job = enqueue_job(extract, ('ini-path', {'id': 'foo'}), job_id='a-task')
+    assert_true('a-task' in rq_queue.job_ids, 'Job was not enqueued.')
+    cancel_job('a-task')
+    assert_false('a-task' in rq_queue.job_ids, 'Job was not cancelled.')
+    job.delete()
+    # Jobs that don't exist are ignored
+    cancel_job('does-not-exist')
@@ -93,6 +93,13 @@ setup(
     # https://packaging.python.org/en/latest/technical.html#install-requires-vs-requirements-files
     install_requires=[],
 
+    # Optional dependencies, installed via for example
+    # ``pip install ckanext-extractor[python]``
+    extras_require={
+        # Support for PDF files in the ``python`` extraction backend
+        'python': ['PyPDF2>=1.26.0'],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.
@@ -120,7 +127,11 @@ setup(
         extract = ckanext.extractor.paster:ExtractCommand
         init = ckanext.extractor.paster:InitCommand
         list = ckanext.extractor.paster:ListCommand
+        migrate = ckanext.extractor.paster:MigrateCommand
+        reap = ckanext.extractor.paster:ReapCommand
+        reindex = ckanext.extractor.paster:ReindexCommand
         show = ckanext.extractor.paster:ShowCommand
+        worker = ckanext.extractor.paster:WorkerCommand
     ''',
 
     # If you are changing from the default layout of your extension, you may